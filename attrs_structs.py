@@ -1,10 +1,43 @@
+import functools
+import hashlib
+import itertools
+import linecache
+import math
+import struct
+
+import numpy as np
+
 class Node():
+    # One node is made per record interpreted, so keep them small.
+    __slots__ = ('value', 'parent', 'name', '_start', '_end',
+                 '_ismrecord', '_compiled', '_children')
+
     def __init__(self, value, parent=None, name=None):
         self.value = value
         self.parent = parent
         self.name = name
-        self._debug_info = None
+        # Offsets of the first and last byte interpreted, or None.
+        self._start = None
+        self._end = None
         self._ismrecord = False
+        # Whether value holds plain values rather than nodes, as for a
+        # FixedLayout or values_only interpreting.
+        self._compiled = False
+        # Nodes already given out for the items of a compiled value.
+        self._children = None
+
+    @property
+    def _debug_info(self):
+        if self._start is None:
+            return None
+        return {'start' : self._start, 'end' : self._end}
+
+    @_debug_info.setter
+    def _debug_info(self, info):
+        if info is None:
+            self._start = self._end = None
+        else:
+            self._start, self._end = info['start'], info['end']
 
     def add(self, value, name=None):
         if isinstance(self.value, list):
@@ -22,7 +55,21 @@ class Node():
             value.parent = self
 
     def __getitem__(self, *args):
-        if isinstance(self.value, (dict, list)):
+        if isinstance(self.value, (dict, list)) and self._compiled:
+            # Give back a node, same as for meta-records that weren't
+            # compiled, and the same node each time.
+            key = args[0]
+            if self._children is None:
+                self._children = {}
+            elif not isinstance(key, slice) and key in self._children:
+                return self._children[key]
+            item = self.value.__getitem__(*args)
+            node = Node(item, parent=self, name=key)
+            node._compiled = isinstance(item, (dict, list))
+            if not isinstance(key, slice):
+                self._children[key] = node
+            return node
+        elif isinstance(self.value, (dict, list)):
             return self.value.__getitem__(*args)
         else:
             raise ValueError("value is not a valid container.")
@@ -64,64 +111,99 @@ class Node():
         return self._print(self)
 
 
+# Marks a Series or List whose FixedLayout hasn't been looked for yet.
+_uncompiled = object()
+
+class _OffsetRecord:
+    """
+    Base of record functions which also interpret bytes in place:
+    decode(buffer, offset, **kwargs) returns the value and the offset
+    just past the bytes it used, rather than the value and the rest of
+    the source. process_meta_record uses decode when a record function
+    has it, so that no memoryview of the rest is made for each record.
+    Calling the record function works as for any other.
+    """
+    def __call__(self, source, **kwargs):
+        value, offset = self.decode(source, 0, **kwargs)
+        return value, source[offset:]
+
 # TODO: Memoize the basic record functions. saves memory. The
 # initializers, that is.
 class RecordTypes:
-    class Integer:
+    class Decoder(_OffsetRecord):
+        """Makes a record function out of a function decode(buffer,
+        offset, **kwargs) that returns a value and the offset after
+        it. The keyword arguments are those given to record functions
+        (root_record and current)."""
+        def __init__(self, decode):
+            self.decode = decode
+
+    class Integer(_OffsetRecord):
         """Binary record for little endian integers of fixed length."""
         def __init__(self, length, signed=False):
             self.length = length
             self.signed = signed
+            code = _integer_formats.get(length)
+            self._struct = (None if code is None else
+                    struct.Struct('<' + (code if signed else code.upper())))
 
-        def __call__(self, source, **kwargs):
+        def decode(self, buffer, offset, **kwargs):
+            end = offset + self.length
+            if self._struct is not None and len(buffer) >= end:
+                return self._struct.unpack_from(buffer, offset)[0], end
             number = int.from_bytes(
-                    source[:self.length], byteorder='little',
+                    buffer[offset:end], byteorder='little',
                     signed=self.signed)
-            return number, source[self.length:]
+            return number, min(end, len(buffer))
 
-    class FixedLengthString:
+    class FixedLengthString(_OffsetRecord):
         """Binary record for ASCII strings of fixed length."""
         def __init__(self, length):
             self.length = length
 
-        def __call__(self, source, **kwargs):
-            return (bytes(source[:self.length]).decode('ascii'),
-                    source[self.length:])
+        def decode(self, buffer, offset, **kwargs):
+            end = offset + self.length
+            return (str(buffer[offset:end], 'ascii'),
+                    min(end, len(buffer)))
 
-    class AsciiInteger:
+    class AsciiInteger(_OffsetRecord):
         """Binary record for ASCII strings which describe decimal
         numbers (just the characters 0-9), of fixed length."""
         def __init__(self, length):
             self.length = length
 
-        def __call__(self, source, **kwargs):
-            return (int(bytes(source[:self.length]).decode('ascii')),
-                    source[self.length:])
+        def decode(self, buffer, offset, **kwargs):
+            end = offset + self.length
+            return (int(str(buffer[offset:end], 'ascii')),
+                    min(end, len(buffer)))
 
-    class PlainBytes:
+    class PlainBytes(_OffsetRecord):
         def __init__(self, length='unknown'):
             self.length = length
 
-        def __call__(self, source, **kwargs):
+        def decode(self, buffer, offset, **kwargs):
             if self.length == 'unknown':
-                return source, bytes()
+                return buffer[offset:], len(buffer)
             else:
-                return bytes(source[:self.length]), source[self.length:]
+                end = offset + self.length
+                return bytes(buffer[offset:end]), min(end, len(buffer))
 
-    class _FigureOutLater:
+    class _FigureOutLater(_OffsetRecord):
         """length may be 'unknown', or int, or callable, where the
-        callable takes the root_record as the argument."""
+        callable takes the root record and the current record as
+        arguments, like an If's referred_record."""
         def __init__(self, length='unknown'):
             self.length = length
 
-        def __call__(self, source, **kwargs):
+        def decode(self, buffer, offset, root_record=None, current=None,
+                   **kwargs):
             if self.length == 'unknown':
-                return source, bytes()
+                return buffer[offset:], len(buffer)
             else:
                 length = (self.length if isinstance(self.length, int) else
-                            self.length(root_record.root,
-                                root_record.current))
-                return bytes(source[:length]), source[length:]
+                            self.length(root_record, current))
+                end = offset + length
+                return bytes(buffer[offset:end]), min(end, len(buffer))
 
     @staticmethod
     def _bytes_from_bits(*args, order='little'):
@@ -193,17 +275,26 @@ class RecordTypes:
     # correct arrangement, rather than perform arithmetic.
     # TODO: Rename of VAXFloat.
     # TODO: Consider 
-    class Float:
+    class Float(_OffsetRecord):
         """Binary record for floating point numbers in NASA's format,
         which are not IEEE 754 floating point numbers."""
         def __init__(self, Type):
             if Type == 'single':
                 self.length = 4
+                self._struct = struct.Struct('<I')
+                self._from_int = _vax_single_from_int
             elif Type == 'double':
                 self.length = 8
+                self._struct = struct.Struct('<Q')
+                self._from_int = _vax_double_from_int
             else:
                 raise ValueError
 
+        def decode(self, buffer, offset, **kwargs):
+            # Same values as __call__, without copying out the bytes.
+            raw = self._struct.unpack_from(buffer, offset)[0]
+            return self._from_int(raw), offset + self.length
+
         # Could be a bit of a bottleneck of speed if a file has tons
         # of VAX floats. Slow parts:
         # - Creating a bit array.
@@ -230,6 +321,28 @@ class RecordTypes:
             value = sign * fraction * 2 ** exponent
             return value, source[self.length:]
 
+    class FloatArray(_OffsetRecord):
+        """Binary record for a run of consecutive floating point
+        numbers in NASA's format, interpreted all at once into a numpy
+        array. Gives the same values as count Float records, but much
+        faster.
+
+        Type : 'single' or 'double', as for Float.
+        count : The number of floats in the run.
+        """
+        def __init__(self, Type, count):
+            self.Type = Type
+            self.count = count
+            self.length = count * RecordTypes.Float(Type).length
+
+        def decode(self, buffer, offset, **kwargs):
+            end = offset + self.length
+            if end > len(buffer):
+                # As Float does, rather than giving fewer floats.
+                raise struct.error(f'FloatArray needs {self.length} bytes, '
+                                   f'{len(buffer) - offset} left.')
+            return vax_floats_to_array(buffer[offset:end], self.Type), end
+
     class If:
         """A meta-record. Not a record function on its own, but gives
         some information about record functions used within. This
@@ -284,6 +397,7 @@ class RecordTypes:
         # functions of unknown length.
         def __init__(self, **records):
             self.records = records
+            self._layout = _uncompiled
 
         def __call__(self, source, root_record=None, **kwargs):
             return process_meta_record(source, self, **kwargs)
@@ -308,10 +422,353 @@ class RecordTypes:
         """
         def __init__(self, record_list):
             self.record_list = record_list
+            self._layout = _uncompiled
 
         def __call__(self, source, **kwargs):
             return process_meta_record(source, self, **kwargs)
 
+def vax_floats_to_array(source, Type='single', dtype=np.float64):
+    """
+    Interprets a buffer of consecutive VAX floats (the format of
+    RecordTypes.Float) in one pass, rather than one value at a time.
+    The results are bit-for-bit the same as those of RecordTypes.Float.
+
+    Parameters
+    ==========
+
+    source, bytes-like : The floats to interpret. Its length must be a
+        multiple of the length of one float.
+    Type : 'single' (VAX F, 4 bytes) or 'double' (VAX D, 8 bytes).
+    dtype : The dtype of the returned array. float32 is fine for
+        singles, except for magnitudes below 2^-126, which become
+        denormals. Doubles lose precision in float32 as usual.
+
+    Returns
+    =======
+
+    values, numpy.ndarray : One value per float in source.
+    """
+    length = RecordTypes.Float(Type).length
+    if len(source) % length != 0:
+        raise ValueError(
+                f"Buffer of {len(source)} bytes is not a whole number "
+                f"of {length} byte floats.")
+    count = len(source) // length
+    # VAX floats are a series of little endian 16-bit words. The 1st
+    # word holds the sign, the exponent, and the most significant
+    # bits of the fraction. Later words hold less significant bits.
+    words = np.frombuffer(source, dtype='<u2', count=count * length // 2)
+    words = words.reshape(count, length // 2).astype(np.uint64)
+    sign = (words[:, 0] >> 15) & 1
+    exponent = ((words[:, 0] >> 7) & 0xff).astype(np.int64)
+    fraction_bits = words[:, 0] & 0x7f
+    for i in range(1, length // 2):
+        fraction_bits = (fraction_bits << 16) | words[:, i]
+
+    if Type == 'single':
+        # 23 bits fit in a float64 mantissa, so no rounding happens.
+        accum = fraction_bits.astype(np.float64) * 2.0 ** -24
+    else:
+        # 55 bits do not fit. RecordTypes._fraction_from_bits sums the
+        # bits from least to most significant, and the partial sums
+        # are exact until the 54th bit. The last two bits (and the
+        # implicit 0.5) are added one at a time so that the rounding
+        # is the same.
+        low_bits = fraction_bits & np.uint64(2 ** 53 - 1)
+        accum = low_bits.astype(np.float64) * 2.0 ** -56
+        accum = accum + ((fraction_bits >> 53) & 1).astype(np.float64) * 2.0 ** -3
+        accum = accum + ((fraction_bits >> 54) & 1).astype(np.float64) * 2.0 ** -2
+
+    values = np.ldexp(0.5 + accum, exponent - 128)
+    values = np.where(sign == 1, -values, values)
+    values[exponent == 0] = 0.0
+    return values.astype(dtype, copy=False)
+
+# The scalar counterparts of vax_floats_to_array, for a float read as a
+# little endian unsigned integer. Same results as RecordTypes.Float.
+def _vax_single_from_int(raw):
+    exponent = (raw >> 7) & 0xff
+    if exponent == 0:
+        return float(0)
+    fraction = ((raw & 0x7f) << 16) | (raw >> 16)
+    value = math.ldexp(0.5 + fraction * 2.0 ** -24, exponent - 128)
+    return -value if raw & 0x8000 else value
+
+def _vax_double_from_int(raw):
+    exponent = (raw >> 7) & 0xff
+    if exponent == 0:
+        return float(0)
+    fraction = (((raw & 0x7f) << 48) | (((raw >> 16) & 0xffff) << 32) |
+                (((raw >> 32) & 0xffff) << 16) | (raw >> 48))
+    # See vax_floats_to_array for why the last two bits are separate.
+    accum = (fraction & (2 ** 53 - 1)) * 2.0 ** -56
+    if (fraction >> 53) & 1:
+        accum = accum + 2.0 ** -3
+    if (fraction >> 54) & 1:
+        accum = accum + 2.0 ** -2
+    value = math.ldexp(0.5 + accum, exponent - 128)
+    return -value if raw & 0x8000 else value
+
+_integer_formats = {1 : 'b', 2 : 'h', 4 : 'i', 8 : 'q'}
+
+def _leaf_format(record):
+    """Returns the struct format and value converter (or None) for a
+    record function of fixed length, or None if the record function's
+    length isn't fixed or it's not one of the RecordTypes."""
+    kind = type(record)
+    if kind is RecordTypes.Integer:
+        if record.length in _integer_formats:
+            code = _integer_formats[record.length]
+            return (code if record.signed else code.upper()), None
+        return (f'{record.length}s',
+                lambda v, signed=record.signed:
+                    int.from_bytes(v, byteorder='little', signed=signed))
+    elif kind is RecordTypes.FixedLengthString:
+        return f'{record.length}s', lambda v: v.decode('ascii')
+    elif kind is RecordTypes.AsciiInteger:
+        return f'{record.length}s', lambda v: int(v.decode('ascii'))
+    elif kind is RecordTypes.Float:
+        if record.length == 4:
+            return 'I', _vax_single_from_int
+        return 'Q', _vax_double_from_int
+    elif kind is RecordTypes.FloatArray:
+        return (f'{record.length}s',
+                lambda v, Type=record.Type: vax_floats_to_array(v, Type))
+    elif (kind in (RecordTypes.PlainBytes, RecordTypes._FigureOutLater)
+            and isinstance(record.length, int)):
+        return f'{record.length}s', None
+    return None
+
+# What FixedLayout.unpack raises for bytes that its records can't
+# interpret, like a FixedLengthString that isn't ascii.
+_unpack_errors = (struct.error, TypeError, ValueError)
+
+class FixedLayout:
+    """A Series or List meta-record whose records all have a fixed
+    length, compiled into a single struct.Struct. Interprets the whole
+    meta-record in one call, without building a tree of nodes.
+
+    Use FixedLayout.compile rather than the constructor, which returns
+    None for meta-records that can't be compiled.
+    """
+    def __init__(self, meta_record):
+        formats = []
+        self.converters = []
+        self.shape = self._compile(meta_record, formats)
+        self.struct = struct.Struct('<' + ''.join(formats))
+        self.length = self.struct.size
+
+    def _compile(self, record, formats):
+        # shape is a leaf's index in the unpacked values, or a pair of
+        # container type and list of (name, shape) for Series and List.
+        if isinstance(record, RecordTypes.Series):
+            return (dict, [(name, self._compile(child, formats))
+                            for name, child in record.records.items()])
+        elif isinstance(record, RecordTypes.List):
+            return (list, [(None, self._compile(child, formats))
+                            for child in record.record_list])
+        leaf = _leaf_format(record)
+        if leaf is None:
+            raise ValueError(f"Record '{record}' does not have a fixed length.")
+        formats.append(leaf[0])
+        self.converters.append(leaf[1])
+        return len(self.converters) - 1
+
+    @staticmethod
+    def compile(meta_record):
+        """Returns the FixedLayout of a Series or List meta-record, or
+        None if it has records without a fixed length. The result is
+        remembered on the meta-record."""
+        if meta_record._layout is _uncompiled:
+            try:
+                meta_record._layout = FixedLayout(meta_record)
+            except ValueError:
+                meta_record._layout = None
+        return meta_record._layout
+
+    def _build(self, shape, values):
+        if isinstance(shape, int):
+            return values[shape]
+        container, children = shape
+        if container is dict:
+            return {name : self._build(child, values)
+                    for name, child in children}
+        return [self._build(child, values) for _, child in children]
+
+    def unpack(self, source, offset=0):
+        """Interprets self.length bytes of source from offset. Returns
+        the same values as tree_to_values would for the meta-record."""
+        values = [value if convert is None else convert(value)
+                  for convert, value in zip(
+                      self.converters, self.struct.unpack_from(source, offset))]
+        return self._build(self.shape, values)
+
+def _leaf_column(record, raw):
+    """Turns raw, an (N, length) uint8 array of the bytes of a fixed
+    length record function, into a column of its N values."""
+    kind = type(record)
+    count = len(raw)
+    if kind is RecordTypes.Integer:
+        if record.length in _integer_formats:
+            dtype = f"<{'i' if record.signed else 'u'}{record.length}"
+            return raw.view(dtype).reshape(count)
+        return np.array([int.from_bytes(bytes(row), byteorder='little',
+                                        signed=record.signed)
+                         for row in raw], dtype=np.int64)
+    elif kind is RecordTypes.FixedLengthString:
+        return np.char.decode(raw.view(f'S{record.length}').reshape(count),
+                              'ascii')
+    elif kind is RecordTypes.AsciiInteger:
+        return raw.view(f'S{record.length}').reshape(count).astype(np.int64)
+    elif kind is RecordTypes.Float:
+        return vax_floats_to_array(
+                raw.reshape(-1), 'single' if record.length == 4 else 'double')
+    elif kind is RecordTypes.FloatArray:
+        return vax_floats_to_array(raw.reshape(-1), record.Type).reshape(
+                count, record.count)
+    # Plain bytes, kept as they are.
+    return raw.view(f'V{raw.shape[1]}').reshape(count)
+
+def fixed_length(record):
+    """The number of bytes a record function or meta-record always
+    interprets, or None if that isn't fixed."""
+    if isinstance(record, (RecordTypes.Series, RecordTypes.List)):
+        layout = FixedLayout.compile(record)
+        return None if layout is None else layout.length
+    leaf = _leaf_format(record)
+    return None if leaf is None else struct.calcsize('<' + leaf[0])
+
+def record_columns(rows, record, prefix=''):
+    """
+    Interprets many instances of a record function or meta-record with
+    a FixedLayout at once, into a column per record function instead
+    of a dict per instance.
+
+    Parameters
+    ==========
+
+    rows, numpy.ndarray : (N, length) uint8 array, with the bytes of
+        one instance per row. length is at least the FixedLayout's.
+    record : A record function or meta-record with a FixedLayout.
+    prefix, str : Put in front of every column name.
+
+    Returns
+    =======
+
+    columns, dict : Column name to numpy array of N values. Names of
+        records within Series are joined with '.'. A List whose
+        records are all alike is one column of shape (N, len(List)),
+        other Lists get a column per index. Floats are float64,
+        strings are numpy strings (without trailing NUL characters),
+        and PlainBytes are numpy voids.
+    """
+    columns = {}
+    _add_columns(np.ascontiguousarray(rows, dtype=np.uint8), record, prefix,
+                 0, columns)
+    return columns
+
+def _add_columns(rows, record, name, offset, columns):
+    """Adds the columns of record, found at offset in rows, to columns.
+    Returns the offset after record."""
+    if isinstance(record, RecordTypes.Series):
+        for key, child in record.records.items():
+            offset = _add_columns(rows, child, f'{name}.{key}' if name else key,
+                                  offset, columns)
+        return offset
+    elif isinstance(record, RecordTypes.List):
+        children = record.record_list
+        kinds = {(type(child), _leaf_format(child)[0],
+                  getattr(child, 'signed', None))
+                 if _leaf_format(child) is not None else None
+                 for child in children}
+        if len(kinds) == 1 and None not in kinds:
+            first = children[0]
+            size = struct.calcsize('<' + _leaf_format(first)[0])
+            length = size * len(children)
+            # Each element's bytes are next to each other, so the
+            # elements can be interpreted as one column, then split up.
+            flat = np.ascontiguousarray(
+                    rows[:, offset:offset + length]).reshape(-1, size)
+            column = _leaf_column(first, flat)
+            columns[name] = column.reshape(
+                    (len(rows), len(children)) + column.shape[1:])
+            return offset + length
+        for i, child in enumerate(children):
+            offset = _add_columns(rows, child, f'{name}.{i}' if name else str(i),
+                                  offset, columns)
+        return offset
+
+    length = fixed_length(record)
+    if length is None:
+        raise ValueError(f"Record '{record}' does not have a fixed length.")
+    if length == 0:
+        return offset
+    columns[name] = _leaf_column(
+            record, np.ascontiguousarray(rows[:, offset:offset + length]))
+    return offset + length
+
+def _code_parts(code):
+    """What a code object does, for schema_fingerprint. Nested code
+    objects (of lambdas within) are included too."""
+    parts = [code.co_code, repr(code.co_names)]
+    for constant in code.co_consts:
+        if hasattr(constant, 'co_code'):
+            parts.extend(_code_parts(constant))
+        elif isinstance(constant, frozenset):
+            # Its order changes with string hashing.
+            parts.append(repr(sorted(map(repr, constant))))
+        else:
+            parts.append(repr(constant))
+    return [part if isinstance(part, bytes) else part.encode() for part in parts]
+
+def _fingerprint_parts(thing, parts):
+    if isinstance(thing, dict):
+        for key, value in thing.items():
+            parts.append(repr(key).encode())
+            _fingerprint_parts(value, parts)
+        return
+    parts.append(type(thing).__qualname__.encode())
+    if isinstance(thing, RecordTypes.Series):
+        _fingerprint_parts(thing.records, parts)
+    elif isinstance(thing, RecordTypes.List):
+        for child in thing.record_list:
+            _fingerprint_parts(child, parts)
+    elif hasattr(thing, '__code__'):
+        parts.extend(_code_parts(thing.__code__))
+    else:
+        # A record function object. Its settings, and how its class
+        # interprets bytes.
+        for name, value in sorted(vars(thing).items()):
+            if name.startswith('_'):
+                continue
+            parts.append(name.encode())
+            if callable(value):
+                _fingerprint_parts(value, parts)
+            else:
+                parts.append(repr(value).encode())
+        for method in ['__call__', 'decode']:
+            function = getattr(type(thing), method, None)
+            if hasattr(function, '__code__'):
+                parts.extend(_code_parts(function.__code__))
+
+def schema_fingerprint(*things):
+    """
+    A hex digest of record functions and meta-records, which changes
+    when what they interpret does. Series and List are followed into.
+    For If records and other functions, their code is used, so records
+    they refer to by name (like a dict of labels) should be passed too.
+    Dicts of records are followed into. Depends on the Python version,
+    as code does.
+    """
+    parts = []
+    for thing in things:
+        _fingerprint_parts(thing, parts)
+    sha256 = hashlib.sha256()
+    for part in parts:
+        sha256.update(len(part).to_bytes(8, 'little'))
+        sha256.update(part)
+    return sha256.hexdigest()
+
 # Mutates original tree.
 # TODO: Changes from Node._print are applicable here, too.
 def tree_to_values(tree):
@@ -332,7 +789,8 @@ def tree_to_values(tree):
 # process_meta_record internally.
 # TODO: Give meta records starts and ends, too, based on the start of
 # their first child and end of their last child.
-def process_meta_record(source, meta_record, start=0):
+def process_meta_record(source, meta_record, start=0, compile_fixed=None,
+                        values_only=False):
     """
     Uses a meta-record to interpret a source of bytes. Behaves
     somewhat like a record function, returning an interpreted value
@@ -344,15 +802,41 @@ def process_meta_record(source, meta_record, start=0):
     source, memoryview: A memoryview of bytes object. Bytes from this
         source will be interpreted by meta_record.
     meta_record : one of RecordTypes's If, Series, or List.
+    start, int : The offset of source, used for debug info.
+    compile_fixed, bool : Whether to interpret Series and List
+        meta-records that have a FixedLayout in one call. Their node
+        then holds plain values rather than a node per record, and
+        debug info only for the whole meta-record. Indexing the node
+        still gives nodes. meta_record itself is always interpreted
+        one record at a time. By default, only for values_only, so
+        that a tree has debug info for every record.
+
+    Record functions with a decode method (all of RecordTypes's do,
+    see _OffsetRecord) are given source and an offset into it. Other
+    record functions are called with the rest of source, as always.
+
+    values_only, bool : Whether to build the plain values (what
+        tree_to_values gives) rather than a tree. Only Series and List
+        get a node, for If records and record functions to look
+        values up in, and no debug info is kept. Much less memory and
+        time for records that are only wanted for their values.
 
     Returns
     =======
 
-    tree, Node: The tree of interpreted values.
+    tree, Node: The tree of interpreted values. Plain values for
+        values_only.
     remaining_source, memoryview : The bytes not consumed from source.
     """
+    if compile_fixed is None:
+        compile_fixed = values_only
+    if values_only:
+        return _process_values(source, meta_record, start, compile_fixed)
+
     root = Node(None)
-    remaining_source = source
+    # Records are interpreted in place, at offset within source.
+    # Record functions without decode are given source[offset:].
+    offset = 0
 
     # elements of node_stack will contain an old tree node and its
     # corresponding new tree node. And the node's name if it has one.
@@ -361,23 +845,47 @@ def process_meta_record(source, meta_record, start=0):
     while len(node_stack) != 0:
         # Old nodes are meta-record functions, or record functions.
         old, new, name = node_stack.pop()
+        if (compile_fixed and new is not root and
+                isinstance(old, (RecordTypes.Series, RecordTypes.List))):
+            layout = FixedLayout.compile(old)
+            value = None
+            if layout is not None and len(source) - offset >= layout.length:
+                try:
+                    value = layout.unpack(source, offset)
+                except _unpack_errors:
+                    # Interpreting one record at a time below reports
+                    # which record is at fault.
+                    pass
+            if value is not None:
+                new.value = value
+                new._compiled = True
+                new._start, new._end = start, start + layout.length - 1
+                offset += layout.length
+                start += layout.length
+                continue
+
         if isinstance(old, RecordTypes.Series):
             old_children = old.records.items()
             new.value = dict()
             new._ismrecord = True
-            length = len(node_stack)
+            children = []
             for k, v in old_children:
                 new_node = Node(None, parent=new, name=k)
-                node_stack.insert(length, [v, new_node, k])
+                children.append([v, new_node, k])
                 new.add(new_node, name=k)
+            # The first child must be popped first, so it goes on top.
+            # Pushing them reversed keeps this linear in the number of
+            # children, where inserting each one under the last wasn't.
+            node_stack.extend(reversed(children))
         elif isinstance(old, RecordTypes.List):
             new.value = list()
             new._ismrecord = True
-            length = len(node_stack)
+            children = []
             for i, child in enumerate(old.record_list):
                 new_node = Node(None, parent=new, name=i)
-                node_stack.insert(length, [child, new_node, i])
+                children.append([child, new_node, i])
                 new.add(new_node, name=None)
+            node_stack.extend(reversed(children))
         elif isinstance(old, RecordTypes.If):
             resolved_record = old(root, new.p)
             node_stack.append([resolved_record, new, name])
@@ -388,9 +896,14 @@ def process_meta_record(source, meta_record, start=0):
             # could be passed source to consume it, and returned
             # remaining source.
             try:
-                orig_length = len(remaining_source)
-                value, remaining_source = old(
-                        remaining_source, root_record=root, current=new.p)
+                decode = getattr(old, 'decode', None)
+                if decode is not None:
+                    value, new_offset = decode(
+                            source, offset, root_record=root, current=new.p)
+                else:
+                    rest = source[offset:]
+                    value, rest = old(rest, root_record=root, current=new.p)
+                    new_offset = len(source) - len(rest)
                 # In case the record function uses metarecords inside of
                 # it, try to play nice with that case.
                 if isinstance(value, Node):
@@ -400,10 +913,10 @@ def process_meta_record(source, meta_record, start=0):
                 else:
                     new.value = value
 
-                new_length = len(remaining_source)
-                consumed_bytes = orig_length - new_length
+                consumed_bytes = new_offset - offset
+                offset = new_offset
 
-                new._debug_info = {'start' : start, 'end' : start + consumed_bytes - 1}
+                new._start, new._end = start, start + consumed_bytes - 1
                 start += consumed_bytes
             except Exception as e:
                 names = []
@@ -416,10 +929,277 @@ def process_meta_record(source, meta_record, start=0):
                 names.append('/')
                 names.reverse()
                 print(f"Node '{names}', caused the following error:")
-                print(f"Bytes starting at '{start}': {bytes(remaining_source[:old.length])}")
+                print(f"Bytes starting at '{start}': {_error_bytes(source, offset, old)}")
                 raise e
 
-    return root, remaining_source, start
+    return root, source[offset:], start
+
+def _error_bytes(source, offset, record):
+    """The bytes from offset that record was interpreting, for error
+    messages. Records without a fixed length (like Decoders) show the
+    next 32."""
+    length = getattr(record, 'length', None)
+    if not isinstance(length, int):
+        length = 32
+    return bytes(source[offset:offset + length])
+
+def _node_names(node, name):
+    """The names from the root to node, then name, for error messages."""
+    names = [name]
+    while node is not None and node.p is not None:
+        names.append(node.name)
+        node = node.p
+    names.append('/')
+    names.reverse()
+    return names
+
+def _process_values(source, meta_record, start, compile_fixed):
+    """process_meta_record for values_only. Same traversal, but the
+    values go straight into plain dicts and lists. Each Series and List
+    gets a compiled Node over its container, which is what If records
+    and record functions are given as root_record and current."""
+    # holder.value[0] receives the value of meta_record itself.
+    holder = Node([None])
+    holder._compiled = True
+    root = None
+    offset = 0
+
+    # Elements are a record function or meta-record, the node of the
+    # container its value goes in, and its key in that container.
+    node_stack = [(meta_record, holder, 0)]
+
+    while len(node_stack) != 0:
+        old, parent, name = node_stack.pop()
+        if (compile_fixed and parent is not holder and
+                isinstance(old, (RecordTypes.Series, RecordTypes.List))):
+            layout = FixedLayout.compile(old)
+            if layout is not None and len(source) - offset >= layout.length:
+                try:
+                    parent.value[name] = layout.unpack(source, offset)
+                    offset += layout.length
+                    continue
+                except _unpack_errors:
+                    # Interpreted one record at a time below instead.
+                    pass
+
+        if isinstance(old, (RecordTypes.Series, RecordTypes.List)):
+            if isinstance(old, RecordTypes.Series):
+                value = dict.fromkeys(old.records)
+                children = list(old.records.items())
+            else:
+                value = [None] * len(old.record_list)
+                children = list(enumerate(old.record_list))
+            parent.value[name] = value
+            node = Node(value, parent=None if parent is holder else parent,
+                        name=name)
+            node._ismrecord = True
+            node._compiled = True
+            if root is None:
+                root = node
+            # Reversed, so that the first child is popped first.
+            node_stack.extend((child, node, key)
+                              for key, child in reversed(children))
+        elif isinstance(old, RecordTypes.If):
+            node_stack.append((old(root, parent), parent, name))
+        else:
+            try:
+                decode = getattr(old, 'decode', None)
+                if decode is not None:
+                    value, offset = decode(
+                            source, offset, root_record=root, current=parent)
+                else:
+                    rest = source[offset:]
+                    value, rest = old(rest, root_record=root, current=parent)
+                    offset = len(source) - len(rest)
+                if isinstance(value, Node):
+                    value = tree_to_values(value)
+                parent.value[name] = value
+            except Exception as e:
+                names = _node_names(parent, name)
+                print(f"Node '{names}', caused the following error:")
+                print(f"Bytes starting at '{start + offset}': "
+                      f"{_error_bytes(source, offset, old)}")
+                raise e
+
+    return holder.value[0], source[offset:], start + offset
+
+def _view_node(value, parent, name):
+    """The node that generated decoders give If records and record
+    functions for a container of plain values."""
+    node = Node(value, parent=parent, name=name)
+    node._ismrecord = True
+    node._compiled = True
+    return node
+
+class _DecoderWriter:
+    """Writes the Python source of a decoder for a record function or
+    meta-record. See compile_decoder."""
+    def __init__(self):
+        self.lines = []
+        self.namespace = {
+            '_view_node' : _view_node,
+            '_Node' : Node,
+            '_tree_to_values' : tree_to_values,
+            '_compile_decoder' : compile_decoder,
+        }
+        # Fixed length leaves not yet unpacked: their struct format,
+        # the expression of their value in terms of {}, and the
+        # expression they're assigned to.
+        self.pending = []
+        self.names = 0
+
+    def name(self, prefix):
+        self.names += 1
+        return f'{prefix}{self.names}'
+
+    def constant(self, value):
+        name = self.name('_k')
+        self.namespace[name] = value
+        return name
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def flush(self):
+        """Unpacks the pending leaves with one struct."""
+        if not self.pending:
+            return
+        unpacker = struct.Struct('<' + ''.join(f for f, _, _ in self.pending))
+        values = self.name('_t')
+        self.emit(f'{values} = {self.constant(unpacker)}.unpack_from(buffer, offset)')
+        self.emit(f'offset += {unpacker.size}')
+        for i, (_, expression, target) in enumerate(self.pending):
+            self.emit(f'{target} = ' + expression.format(f'{values}[{i}]'))
+        self.pending = []
+
+    def views(self, path):
+        """Emits the nodes for the containers in path, pairs of a
+        container and its name, from the root in. Returns the
+        expressions of the root record and the current record."""
+        if not path:
+            return 'root_record', 'current'
+        nodes = []
+        parent = 'current'
+        for container, name in path:
+            node = self.name('_n')
+            self.emit(f'{node} = _view_node({container}, {parent}, {name!r})')
+            nodes.append(node)
+            parent = node
+        root = self.name('_root')
+        self.emit(f'{root} = {nodes[0]} if root_record is None else root_record')
+        return root, nodes[-1]
+
+    def write(self, record, target, path, name=None):
+        """Emits the code interpreting record into target. path is the
+        containers that target is in, as for views."""
+        kind = type(record)
+        if kind is RecordTypes.Series or kind is RecordTypes.List:
+            container = self.name('c')
+            if kind is RecordTypes.Series:
+                self.emit(f'{container} = dict.fromkeys({tuple(record.records)!r})')
+                children = record.records.items()
+            else:
+                self.emit(f'{container} = [None] * {len(record.record_list)}')
+                children = enumerate(record.record_list)
+            self.emit(f'{target} = {container}')
+            path = path + [(container, name)]
+            for key, child in children:
+                self.write(child, f'{container}[{key!r}]', path, key)
+            return
+
+        leaf = _leaf_format(record)
+        if leaf is not None:
+            code, convert = leaf
+            if kind is RecordTypes.FixedLengthString:
+                expression = "{}.decode('ascii')"
+            elif kind is RecordTypes.AsciiInteger:
+                expression = "int({}.decode('ascii'))"
+            elif convert is None:
+                expression = '{}'
+            else:
+                expression = self.constant(convert) + '({})'
+            self.pending.append((code, expression, target))
+            return
+
+        # Anything else may look at the values before it.
+        self.flush()
+        root, current = self.views(path)
+        if kind is RecordTypes.If:
+            # A branch per value of the referred record, each compiled
+            # the first time that value is seen.
+            condition = self.constant(record)
+            branches = self.constant({})
+            value, decode = self.name('_v'), self.name('_d')
+            self.emit(f'{value} = {condition}.referred_record({root}, {current}).value')
+            self.emit(f'{decode} = {branches}.get({value})')
+            self.emit(f'if {decode} is None:')
+            self.emit(f'    {decode} = {branches}[{value}] = _compile_decoder('
+                      f'{condition}.action({value}))')
+            self.emit(f'{target}, offset = {decode}(buffer, offset, {root}, {current})')
+        elif hasattr(record, 'decode'):
+            self.emit(f'{target}, offset = {self.constant(record)}.decode('
+                      f'buffer, offset, root_record={root}, current={current})')
+        else:
+            value, rest = self.name('_v'), self.name('_rest')
+            self.emit(f'{value}, {rest} = {self.constant(record)}('
+                      f'buffer[offset:], root_record={root}, current={current})')
+            self.emit(f'offset = len(buffer) - len({rest})')
+            self.emit(f'if isinstance({value}, _Node):')
+            self.emit(f'    {value} = _tree_to_values({value})')
+            self.emit(f'{target} = {value}')
+
+_decoder_count = itertools.count()
+
+@functools.lru_cache(maxsize=256)
+def compile_decoder(record):
+    """
+    Compiles a record function or meta-record into a Python function
+    written for it, which gives the same values as
+    process_meta_record(..., values_only=True), but much faster. Runs
+    of fixed length records, across Series and List, are unpacked by
+    one struct. An If gets a branch per value of the record it refers
+    to, so its action must depend only on that value. Decoders are
+    cached per record.
+
+    Parameters
+    ==========
+
+    record : A record function or one of RecordTypes's meta-records.
+
+    Returns
+    =======
+
+    decode, callable : decode(buffer, offset=0) returns the values and
+        the offset after them. decode.source is the generated code. If
+        the generated code can't interpret the bytes (a struct.error,
+        TypeError or ValueError), process_meta_record interprets them
+        instead, so errors are reported as usual. Other errors are
+        raised as they are.
+    """
+    writer = _DecoderWriter()
+    writer.write(record, 'result', [])
+    writer.flush()
+    filename = f'<decoder {next(_decoder_count)}>'
+    source = '\n'.join(
+            ['def decode(buffer, offset=0, root_record=None, current=None):']
+            + writer.lines + ['    return result, offset', ''])
+    exec(compile(source, filename, 'exec'), writer.namespace)
+    # So that tracebacks show the generated lines.
+    linecache.cache[filename] = (len(source), None,
+                                 source.splitlines(True), filename)
+    generated = writer.namespace['decode']
+
+    def decode(buffer, offset=0, root_record=None, current=None):
+        try:
+            return generated(buffer, offset, root_record, current)
+        except _unpack_errors:
+            if root_record is not None:
+                raise
+            value, rest, _ = process_meta_record(
+                    buffer[offset:], record, start=offset, values_only=True)
+            return value, len(buffer) - len(rest)
+    decode.source = source
+    return decode
 
 # TODO:
 # - Create an Ignore metarecord. Can take length or a record function.
@@ -0,0 +1,76 @@
+"""
+Times read_logical_records_parallel against read_logical_records, for
+choosing chunks_per_worker in f_bidr, and whether the pool should be
+used by default.
+
+    python benchmark.py [FILE_15 ...]
+
+Without files, a made up FILE_15 of image records is written to a
+temporary directory at a few sizes. Each reading is timed best of 3.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import f_bidr
+
+def image_record(ref_lines, line_count=100, pixels=512):
+    """An image logical record, with lines of pixels valid pixels."""
+    label = b''.join([
+        line_count.to_bytes(2, 'little'),
+        (pixels + 4).to_bytes(2, 'little'),
+        bytes.fromhex('80400000 60c10000 4941d00f 9e405206'),
+        ref_lines.to_bytes(4, 'little', signed=True),
+        (0).to_bytes(4, 'little', signed=True),
+        (abs(ref_lines) * 7).to_bytes(4, 'little'),
+        b'ID = M0257.22-10'.ljust(32),
+    ])
+    line = (0).to_bytes(2, 'little') + pixels.to_bytes(2, 'little')
+    data = b''.join(line + bytes((ref_lines + i + j) % 256
+                                 for j in range(pixels))
+                    for i in range(line_count))
+    body = b''.join([(2).to_bytes(2, 'little'),
+                     (4 + len(label)).to_bytes(2, 'little'),
+                     (376).to_bytes(2, 'little'),
+                     bytes([2, len(label)]), label, data])
+    return b'NJPL1I000104' + b'%08d' % len(body) + body
+
+def made_up_file(directory, records):
+    path = os.path.join(directory, f'FILE_15-{records}')
+    one = image_record(0)
+    with open(path, 'wb') as f:
+        f.write(one * records)
+    return path
+
+def best_time(function, *args, repeat=3, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark(path, chunks=(1, 2, 4, 8, 16)):
+    # The index is made once, and isn't part of either reading.
+    f_bidr.load_record_index(path)
+    size = os.path.getsize(path) / (1 << 20)
+    # At least 2, so that there's a pool even with one cpu, which
+    # shows what the pool costs.
+    workers = max(2, os.cpu_count())
+    sequential = best_time(f_bidr.read_logical_records, path)
+    print(f'{path}: {size:.1f}MB, {os.cpu_count()} cpus, {workers} workers')
+    print(f'    sequential: {sequential:.2f}s')
+    for chunks_per_worker in chunks:
+        parallel = best_time(f_bidr.read_logical_records_parallel, path,
+                             workers, chunks_per_worker)
+        print(f'    {chunks_per_worker} chunks per worker: {parallel:.2f}s')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            benchmark(path)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            for records in [10, 100, 1000]:
+                benchmark(made_up_file(directory, records))
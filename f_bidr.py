@@ -1,13 +1,23 @@
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import mmap
+import os
+import struct
+import threading
+import zipfile
+
+import numpy as np
+
 from attrs_structs import RecordTypes as R
-from attrs_structs import tree_to_values
+from attrs_structs import vax_floats_to_array, compile_decoder
+from attrs_structs import fixed_length, record_columns, schema_fingerprint
 
 # TODO: 
 # - Translate the times into python/earth times.
-# - Build an index of longitudes + latitudes of the reference points
-#   of each logical record in an image. At least for file 15. This
-#   would allow you to focus on an arbitrary longitude latitude range
-#   without having to worry about which orbit(s) cover it up front.
-#   Helps keep storage use low, too.
+# NOTE: The index of the reference points of the image records of all
+# orbits is f_bidr_data.SpatialIndex.
 tdb_seconds = R.Float('double')
 wall_clock_time = R.FixedLengthString(19)
 vax_int = R.Integer(4)
@@ -149,29 +159,41 @@ data_blocks = {
     )
 }
 
+# The 2 byte offset_to_first and pointer_to_last before each line.
+_line_header = struct.Struct('<HH')
+
 # Multi-look image data, not single-look. I haven't found a
 # single-look image yet.
 # Done manually for speed.
-def image_data_block(source, root_record, current):
+def decode_image_data_block(buffer, offset, root_record, current):
     info = root_record['secondary_header']['annotation_block']['label']
     num_lines = info['line_count'].value
     line_length = info['line_length'].value
     lines = []
-    rest = source
 
     for i in range(num_lines):
-        line = rest[:line_length]
-        rest = rest[line_length:]
+        offset_to_first, pointer_to_last = _line_header.unpack_from(
+                buffer, offset)
         lines.append({
-            'offset_to_first' : R.Integer(2)(line[:2])[0],
-            'pointer_to_last' : R.Integer(2)(line[2:4])[0],
-            'line' : bytearray(line[4:]),
+            'offset_to_first' : offset_to_first,
+            'pointer_to_last' : pointer_to_last,
+            'line' : bytearray(buffer[offset + 4:offset + line_length]),
         })
+        offset += line_length
 
-    return lines, rest
+    return lines, offset
 
+image_data_block = R.Decoder(decode_image_data_block)
 data_blocks['image-data'] = image_data_block
 
+# Processing monitor records (data class 16) aren't processing
+# parameter records (4 and 68), and their layout isn't known yet. Keep
+# their data blocks as bytes.
+def decode_monitor_data_block(buffer, offset, root_record, current):
+    return bytes(buffer[offset:]), len(buffer)
+
+data_blocks['monitor'] = R.Decoder(decode_monitor_data_block)
+
 logical_record = R.Series(
     primary_type=R.FixedLengthString(12),
     remaining_length=R.AsciiInteger(8),
@@ -199,23 +221,35 @@ logical_record = R.Series(
             data_blocks['per-orbit'] if value == 1 else
             data_blocks['image-data'] if 
                 value in [2, 34, 66, 98] else
-            data_blocks['processing/monitor'] if
-                value in [4, 68, 16] else
+            data_blocks['processing'] if value in [4, 68] else
+            data_blocks['monitor'] if value == 16 else
             data_blocks['radiometer']))
 
-def count_logical_recs(source):
-    start = 0
-    records = 0
-    prefix_length = 9
+image_data_classes = [2, 34, 66, 98]
+
+def logical_record_spans(source, start=0):
+    """Yields the (start, end) byte offsets of each logical record in
+    source, using only the length in each primary header. end is
+    exclusive. Stops at a primary header that isn't all there or whose
+    length isn't a number, as at the end of a file that was cut short.
+    The last record's end can still be past the end of source."""
     primary_label_length = 12
-    while start < len(source):
-        check = source.startswith(b'NJPL1I000', start, start+12)
+    while start + 20 <= len(source):
+        check = source[start:start+9] == b'NJPL1I000'
         if not check:
             break
         label_offset = start + primary_label_length
         length_bytes = source[label_offset:label_offset+8]
-        length = R.AsciiInteger(8)(length_bytes)[0]
+        try:
+            length = R.AsciiInteger(8)(length_bytes)[0]
+        except ValueError:
+            break
+        yield start, start + 20 + length
         start += 20 + length
+
+def count_logical_recs(source):
+    records = 0
+    for _ in logical_record_spans(source):
         records += 1
 
     return records
@@ -227,39 +261,488 @@ def rearrange_logical_record(record):
         'data' : record['data_block'],
         'type' : record['secondary_header']['annotation_block']['data_class'],
     }
-    new.update(record['secondary_header']['annotation_block']['label'])
+    label = record['secondary_header']['annotation_block']['label']
+    # Some labels are plain bytes, not yet worked out.
+    if isinstance(label, dict):
+        new.update(label)
+    elif len(label) != 0:
+        new['label'] = label
     new.update(orbit_number=record['secondary_header']['orbit_number'])
     return new
 
+def logical_record_fingerprint():
+    """Changes whenever the records read_logical_records gives would:
+    when logical_record, the labels and data blocks it picks from, or
+    rearrange_logical_record change. See
+    attrs_structs.schema_fingerprint."""
+    return schema_fingerprint(logical_record, annotation_labels, data_blocks,
+                              rearrange_logical_record)
+
+def map_file(filepath):
+    """Maps a file into memory, read-only. Pages are read from disk as
+    they're used, and processes that map the same file share them."""
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap can't map empty files.
+            return bytes()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def open_source(source):
+    """Returns source as a bytes-like object. Paths (strings or
+    path-like objects) are memory mapped rather than read in."""
+    if isinstance(source, (str, os.PathLike)):
+        return map_file(source)
+    return source
+
+def _interpret_span(rest, record_start, record_end):
+    """Interprets and rearranges the logical record in
+    rest[record_start:record_end]."""
+    decode = compile_decoder(logical_record)
+    value, _ = decode(rest[record_start:record_end])
+    return rearrange_logical_record(value)
+
+def iter_logical_records(source, start=None, stop=None, index=None):
+    """
+    Interprets the logical records of source one at a time, as they're
+    asked for. Only the records being interpreted are held in memory.
+
+    - source is a bytes-like object, or a filepath. Files are memory
+      mapped.
+    - start and stop select records by index, as with a slice of the
+      list from read_logical_records. Records before start are skipped
+      over using their lengths, without interpreting them. Nothing
+      past the record before stop is read.
+    - index is the record index of source (see load_record_index). If
+      given, records are found through it, without looking at the
+      records before start at all.
+    """
+    source = open_source(source)
+    rest = memoryview(source)
+    if index is None:
+        spans = itertools.islice(logical_record_spans(source), start, stop)
+    else:
+        rows = index[start:stop]
+        spans = zip(rows['offset'].tolist(),
+                    (rows['offset'] + rows['length']).tolist())
+    for record_start, record_end in spans:
+        yield _interpret_span(rest, record_start, record_end)
+
+def _read_fully(stream, length):
+    """Reads length bytes from stream, less only at its end."""
+    data = bytearray()
+    while len(data) < length:
+        chunk = stream.read(length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+def iter_logical_records_from_stream(stream):
+    """
+    Interprets logical records as they're read from stream, a file-like
+    object such as an HTTP response, one at a time. Only as many bytes
+    as the records asked for are read: the 20 byte primary header of a
+    record gives the length of the rest. Stops at the end of the
+    stream, or at bytes which aren't a primary header.
+    """
+    start = 0
+    while True:
+        primary_header = _read_fully(stream, 20)
+        if primary_header[:9] != b'NJPL1I000':
+            return
+        if len(primary_header) < 20:
+            raise ValueError(f'Logical record at byte {start} was cut short.')
+        remaining_length = R.AsciiInteger(8)(primary_header[12:])[0]
+        rest = _read_fully(stream, remaining_length)
+        if len(rest) < remaining_length:
+            raise ValueError(f'Logical record at byte {start} was cut short.')
+        value, _ = compile_decoder(logical_record)(
+                memoryview(primary_header + rest))
+        yield rearrange_logical_record(value)
+        start += 20 + remaining_length
+
 def read_logical_records(source, number=None):
     """
-    - source is a bytes object, or a filepath as string.
+    - source is a bytes-like object, or a filepath. Files are memory
+      mapped, so only the parts of the file that are interpreted are
+      read from disk.
     - number is the number of records to read. If omitted, read as
       many records as possible.
     - This is not a record function. Think of it as a front-end to
       this whole file.
     """
-    if isinstance(source, str):
-        with open(source, 'rb') as f:
-            contents = f.read()
-            rest = memoryview(contents)
-        max_records = count_logical_recs(contents)
+    return list(iter_logical_records(source, stop=number))
+
+# The parts of an image logical record which come before the data
+# block: the headers and annotation_labels['image-data']. Floats are
+# left as raw bytes, they're VAX floats.
+_image_header_layout = np.dtype([
+    ('primary_header', 'S20'),
+    ('secondary_type', '<u2'),
+    ('remaining_length', '<u2'),
+    ('orbit_number', '<u2'),
+    ('data_class', 'u1'),
+    ('annotation_length', 'u1'),
+    ('line_count', '<u2'),
+    ('line_length', '<u2'),
+    ('floats', 'S16'),
+    ('reference_offset_lines', '<i4'),
+    ('reference_offset_pixels', '<i4'),
+    ('burst_counter', '<u4'),
+    ('nav_unique_id', 'S32'),
+])
+
+image_header_dtype = np.dtype([
+    ('record_offset', '<i8'),
+    ('data_offset', '<i8'),
+    ('orbit_number', '<u2'),
+    ('data_class', 'u1'),
+    ('line_count', '<u2'),
+    ('line_length', '<u2'),
+    ('proj_origin_lat', '<f8'),
+    ('proj_origin_lon', '<f8'),
+    ('reference_lat', '<f8'),
+    ('reference_lon', '<f8'),
+    ('reference_offset_lines', '<i4'),
+    ('reference_offset_pixels', '<i4'),
+    ('burst_counter', '<u4'),
+])
+
+class ImageRecords:
+    """The image logical records of a file as numpy arrays. The image
+    lines are views over the file's bytes; nothing is copied per line.
+
+    header, numpy.ndarray : One row per image record, of
+        image_header_dtype. The fields have the same names as in the
+        records from read_logical_records. record_offset and
+        data_offset are where the logical record and its data block
+        start in buffer.
+    buffer : The bytes (or memory map) of the whole file.
+    """
+    def __init__(self, buffer, header):
+        self.buffer = buffer
+        self.header = header
+
+    def __len__(self):
+        return len(self.header)
+
+    def _view(self, i, dtype, shape, skip, strides=None):
+        row = self.header[i]
+        return np.ndarray(shape, dtype=dtype, buffer=self.buffer,
+                offset=int(row['data_offset']) + skip, strides=strides)
+
+    def lines(self, i):
+        """Pixels of the ith record, (line_count, line_length - 4)
+        uint8, without the offset and pointer of each line."""
+        row = self.header[i]
+        count, length = int(row['line_count']), int(row['line_length'])
+        return self._view(i, np.uint8, (count, length - 4), 4, (length, 1))
+
+    def offset_to_first(self, i):
+        """offset_to_first of each line of the ith record, int16."""
+        row = self.header[i]
+        count, length = int(row['line_count']), int(row['line_length'])
+        return self._view(i, '<i2', (count,), 0, (length,))
+
+    def pointer_to_last(self, i):
+        """pointer_to_last of each line of the ith record, int16."""
+        row = self.header[i]
+        count, length = int(row['line_count']), int(row['line_length'])
+        return self._view(i, '<i2', (count,), 2, (length,))
+
+def _image_headers(buffer, starts):
+    """Interprets the headers of the image records which start at the
+    offsets in starts, all at once. Returns an array of
+    image_header_dtype."""
+    as_bytes = np.frombuffer(buffer, dtype=np.uint8)
+    length = _image_header_layout.itemsize
+    raw = as_bytes[starts[:, None] + np.arange(length)]
+    raw = raw.copy().view(_image_header_layout)[:, 0]
+    floats = vax_floats_to_array(raw['floats'].tobytes(), 'single')
+    floats = floats.reshape(len(raw), 4)
+
+    header = np.zeros(len(raw), dtype=image_header_dtype)
+    header['record_offset'] = starts
+    header['data_offset'] = starts + length
+    for name in ['orbit_number', 'data_class', 'line_count', 'line_length',
+                 'reference_offset_lines', 'reference_offset_pixels',
+                 'burst_counter']:
+        header[name] = raw[name]
+    for i, name in enumerate(['proj_origin_lat', 'proj_origin_lon',
+                              'reference_lat', 'reference_lon']):
+        header[name] = floats[:, i]
+    return header
+
+def read_image_records(source, number=None, offsets=None):
+    """
+    Reads just the image logical records of a file (like FILE_15) into
+    an ImageRecords, without interpreting them record by record.
+
+    - source is a bytes-like object, or a filepath. Files are memory
+      mapped.
+    - number is the number of logical records to look through. If
+      omitted, look through all of them.
+    - offsets are the byte offsets of the records to read, like the
+      offsets in a record index. If given, nothing else in the file is
+      looked at, and number is ignored.
+    """
+    buffer = open_source(source)
+    if offsets is None:
+        spans = itertools.islice(logical_record_spans(buffer), number)
+        starts = np.array([start for start, end in spans], dtype=np.int64)
     else:
-        rest = memoryview(source)
-        max_records = count_logical_recs(source)
+        starts = np.asarray(offsets, dtype=np.int64)
+    as_bytes = np.frombuffer(buffer, dtype=np.uint8)
+    # Discard everything but image records, looking only at data class.
+    starts = starts[np.isin(as_bytes[starts + 26], image_data_classes)]
+    return ImageRecords(buffer, _image_headers(buffer, starts))
 
-    records = []
-    to_read = (max_records if number is None 
-                else min(number, max_records))
+# One row per logical record of a file. The image fields are only
+# filled in for image records. The others have zeros, and NaN for
+# reference_lat and reference_lon.
+record_index_dtype = np.dtype([
+    ('offset', '<i8'),
+    ('length', '<i8'),
+    ('data_class', 'u1'),
+    ('line_count', '<u2'),
+    ('line_length', '<u2'),
+    ('reference_lat', '<f8'),
+    ('reference_lon', '<f8'),
+    ('reference_offset_lines', '<i4'),
+    ('reference_offset_pixels', '<i4'),
+])
 
-    new_start = 0
-    for i in range(to_read):
-        value, rest, new_start = logical_record(rest, start=new_start)
-        records.append(value)
+def build_record_index(source):
+    """Finds every logical record in source in one pass over the
+    primary headers. Returns an array of record_index_dtype. The bytes
+    of record k are source[offset:offset + length] of row k."""
+    buffer = open_source(source)
+    spans = np.array(list(logical_record_spans(buffer)), dtype=np.int64)
+    spans = spans.reshape(-1, 2)
+    # A record cut short by the end of the file isn't a record. Nor is
+    # one too short to have a data class.
+    spans = spans[(spans[:, 1] <= len(buffer)) & (spans[:, 1] - spans[:, 0] > 26)]
+    as_bytes = np.frombuffer(buffer, dtype=np.uint8)
 
-    records = [tree_to_values(r) for r in records]
-    records = [rearrange_logical_record(r) for r in records]
-    return records
+    index = np.zeros(len(spans), dtype=record_index_dtype)
+    index['offset'] = spans[:, 0]
+    index['length'] = spans[:, 1] - spans[:, 0]
+    index['data_class'] = as_bytes[spans[:, 0] + 26]
+    index['reference_lat'] = np.nan
+    index['reference_lon'] = np.nan
+
+    is_image = (np.isin(index['data_class'], image_data_classes) &
+                (index['length'] >= _image_header_layout.itemsize))
+    header = _image_headers(buffer, index['offset'][is_image])
+    for name in ['line_count', 'line_length', 'reference_lat',
+                 'reference_lon', 'reference_offset_lines',
+                 'reference_offset_pixels']:
+        index[name][is_image] = header[name]
+    return index
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """
+    For a with statement. Gives a file opened for writing bytes, which
+    becomes path once the with statement is done, so that a reader of
+    path never sees half a file. The file is written beside path. If
+    the with statement raises, the file is removed and path is left as
+    it was.
+    """
+    partial_path = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+    try:
+        with open(partial_path, 'wb') as f:
+            yield f
+        os.replace(partial_path, path)
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+        raise
+
+def record_index_path(filepath):
+    """The record index of a file is kept beside it."""
+    return f'{filepath}.index.npz'
+
+def load_record_index(filepath):
+    """
+    Returns the record index (see build_record_index) of the file at
+    filepath. The index is saved beside the file the first time, and
+    loaded from there afterwards, unless the file's size or
+    modification time has changed since.
+    """
+    filepath = os.fspath(filepath)
+    stat = os.stat(filepath)
+    index_path = record_index_path(filepath)
+    try:
+        with np.load(index_path) as saved:
+            if (saved['source_size'] == stat.st_size and
+                    saved['source_mtime'] == stat.st_mtime_ns):
+                return saved['index']
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+
+    index = build_record_index(filepath)
+    # Not being able to save the index (eg a read-only directory) only
+    # makes the next load slower.
+    try:
+        with atomic_write(index_path) as f:
+            np.savez_compressed(f, index=index, source_size=stat.st_size,
+                                source_mtime=stat.st_mtime_ns)
+    except OSError:
+        pass
+    return index
+
+def record_schema(data_class):
+    """The label and data block meta-records (or record functions) of
+    logical records of data_class, as logical_record picks them."""
+    annotation = logical_record.records['secondary_header'].records['annotation_block']
+    return (annotation.records['label'].action(data_class),
+            logical_record.records['data_block'].action(data_class))
+
+def read_record_columns(source, data_class, offsets=None):
+    """
+    Interprets every logical record of a data class into a column per
+    field, rather than a dict per record. The columns of the label use
+    the field names, as rearrange_logical_record does, and those of the
+    data block start with 'data.' (see attrs_structs.record_columns).
+    offset, data_class and orbit_number columns are added too. Image
+    data blocks aren't fixed length, so only their labels are read;
+    see read_image_records for the image data.
+
+    - source is a bytes-like object, or a filepath. Files are memory
+      mapped.
+    - data_class is one data class, or a list of data classes whose
+      records are interpreted the same way, like image_data_classes.
+    - offsets are the byte offsets of the records to look at, like the
+      offsets in a record index. If omitted, all records are.
+    """
+    buffer = open_source(source)
+    if offsets is None:
+        starts = np.array([start for start, end in logical_record_spans(buffer)],
+                          dtype=np.int64)
+    else:
+        starts = np.asarray(offsets, dtype=np.int64)
+    classes = np.atleast_1d(data_class)
+    schemas = {tuple(map(id, record_schema(int(c)))) for c in classes}
+    if len(schemas) != 1:
+        raise ValueError(f'Data classes {list(classes)} are not interpreted '
+                         'the same way.')
+    label, data = record_schema(int(classes[0]))
+
+    as_bytes = np.frombuffer(buffer, dtype=np.uint8)
+    starts = starts[np.isin(as_bytes[starts + 26], classes)]
+    columns = {
+        'offset' : starts,
+        'data_class' : as_bytes[starts + 26],
+        'orbit_number' : (as_bytes[starts + 24].astype(np.uint16) |
+                          as_bytes[starts + 25].astype(np.uint16) << 8),
+    }
+    # The label follows the 28 bytes of the primary and secondary
+    # headers, and the data block follows the label.
+    position = 28
+    for record, prefix in [(label, ''), (data, 'data')]:
+        length = fixed_length(record)
+        if length is None:
+            break
+        if not prefix and not isinstance(record, R.Series):
+            prefix = 'label'
+        rows = as_bytes[starts[:, None] + np.arange(position, position + length)]
+        columns.update(record_columns(rows, record, prefix))
+        position += length
+    return columns
+
+def _read_spans(filepath, offsets, lengths):
+    """Worker for read_logical_records_parallel. Each worker maps the
+    file itself, rather than being sent its bytes."""
+    rest = memoryview(map_file(filepath))
+    return [_interpret_span(rest, start, start + length)
+            for start, length in zip(offsets, lengths)]
+
+def read_logical_record_at(source, offset):
+    """Interprets just the logical record which starts at byte offset
+    of source, like the offsets in a record index."""
+    source = open_source(source)
+    start, end = next(logical_record_spans(source, offset))
+    return _interpret_span(memoryview(source), start, end)
+
+def read_logical_records_parallel(filepath, workers=None, chunks_per_worker=4):
+    """
+    Same as read_logical_records for a file, but the records are split
+    into chunks that are interpreted in a pool of worker processes. The
+    records are in the same order as from read_logical_records.
+
+    - filepath is the path of the file. The workers memory map it, so
+      they share the pages in memory.
+    - workers is the number of worker processes. The pool has to be
+      asked for: without workers, or with one, the file is read by
+      read_logical_records. The records are pickled back from the
+      workers, which costs about as much as reading them, so a pool
+      only pays with several cpus to spare (see benchmark.py).
+    - chunks_per_worker is the number of chunks the records are split
+      into per worker. More chunks balance the load better.
+    """
+    filepath = os.fspath(filepath)
+    if workers is None or workers <= 1:
+        return read_logical_records(filepath)
+    index = load_record_index(filepath)
+    chunk_count = max(1, min(len(index), workers * chunks_per_worker))
+    chunks = np.array_split(index, chunk_count)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(_read_spans,
+                itertools.repeat(filepath),
+                [chunk['offset'].tolist() for chunk in chunks],
+                [chunk['length'].tolist() for chunk in chunks])
+        return [record for chunk in results for record in chunk]
+
+class LogicalRecordFile:
+    """
+    The logical records of a file, as a sequence. Supports len(),
+    indexing and slicing. Records are interpreted only when they're
+    looked at, and the most recently used ones are kept.
+
+    - source is a bytes-like object, or a filepath. Files are memory
+      mapped, and their record index (see load_record_index) is saved
+      beside them.
+    - cache_size is the number of interpreted records to keep.
+    """
+    def __init__(self, source, cache_size=1024):
+        if isinstance(source, (str, os.PathLike)):
+            self.index = load_record_index(source)
+        else:
+            self.index = build_record_index(source)
+        self.source = open_source(source)
+        self.cache_size = cache_size
+        self._rest = memoryview(self.source)
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('logical record index out of range')
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        start = int(self.index['offset'][key])
+        record = _interpret_span(
+                self._rest, start, start + int(self.index['length'][key]))
+        self._cache[key] = record
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return record
 
 # File 15 notes:
 # - For the 1st 1000 logical records of the test FILE_15, all the line
@@ -1,8 +1,19 @@
-import urllib.request
 import urllib.error
+import urllib.parse
+import http.client
+import concurrent.futures
+import threading
+import collections.abc
+import hashlib
+import pickle
+import sqlite3
+import time
 import os.path
 import os
-import shutil
+
+import numpy as np
+
+import f_bidr
 
 # I don't wanna think about the version. If I request an orbit, I
 # should get the latest version of the orbit, unless I specify
@@ -16,17 +27,71 @@ import shutil
 # - Consider prioritizing the latest version orbit that's currently on
 #   the computer over downloading the latest orbit version.
 # - Figure out what those versions actually mean. Is later better?
-with open('record-order') as f:
-    orbits = {}
-    for line in f:
-        path = line[:-1]
-        name = path.split('/')[-1]
-        number = int(name[1:5])
-        version = int(name.split('_')[-1])
-        if number in orbits:
-            orbits[number].append(path)
-        else:
-            orbits[number] = [path]
+def parse_record_order(path):
+    """Reads the list of orbit directories (like record-order) into a
+    dict from orbit number to the directory of each version."""
+    with open(path) as f:
+        orbits = {}
+        for line in f:
+            path = line[:-1]
+            name = path.split('/')[-1]
+            number = int(name[1:5])
+            version = int(name.split('_')[-1])
+            if number in orbits:
+                orbits[number].append(path)
+            else:
+                orbits[number] = [path]
+    return orbits
+
+class OrbitCatalog(collections.abc.Mapping):
+    """
+    The orbits of a record-order file, as from parse_record_order. The
+    file is only read the first time the catalog is used, not on
+    import. The parsed catalog is pickled into cache_path, and used
+    instead of the file for as long as the file's modification time
+    and size stay the same.
+    """
+    def __init__(self, path, cache_path):
+        self.path = path
+        self.cache_path = cache_path
+        self._orbits = None
+
+    def _load(self):
+        stat = os.stat(self.path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(self.cache_path, 'rb') as f:
+                saved_key, orbits = pickle.load(f)
+            if saved_key == key:
+                return orbits
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+        orbits = parse_record_order(self.path)
+        # Not being able to write the cache (eg a read-only checkout)
+        # only makes the next use slower.
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with f_bidr.atomic_write(self.cache_path) as f:
+                pickle.dump((key, orbits), f, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+        return orbits
+
+    @property
+    def loaded(self):
+        if self._orbits is None:
+            self._orbits = self._load()
+        return self._orbits
+
+    def __getitem__(self, number):
+        return self.loaded[number]
+
+    def __iter__(self):
+        return iter(self.loaded)
+
+    def __len__(self):
+        return len(self.loaded)
 
 f_bidr_root = "http://pds-geosciences.wustl.edu/mgn/mgn-v-rdrs-5-bidr-full-res-v1/"
 project_root = os.path.dirname(os.path.abspath(__file__))
@@ -35,6 +100,9 @@ project_root = os.path.dirname(os.path.abspath(__file__))
 # path.
 data_root = os.path.join(project_root, 'data')
 
+orbits = OrbitCatalog(os.path.join(project_root, 'record-order'),
+        os.path.join(project_root, '__pycache__', 'record-order.pickle'))
+
 def gen_url(number, version, filename):
     return f'{f_bidr_root}{orbits[number][version - 1]}/{filename.upper()}'
 
@@ -47,40 +115,843 @@ def gen_local_path(number, version, filename):
 def file_exists(number, version, filename):
     return os.path.exists(gen_local_path(number, version, filename))
 
+class _Connections(threading.local):
+    """Keep-alive connections to each host, one set per thread, so
+    that consecutive downloads in a thread reuse connections."""
+    # The connections of every thread, for close_connections, and how
+    # many times they've all been closed.
+    everywhere = set()
+    closings = 0
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.open = {}
+        self.closed_at = _Connections.closings
+
+    def get(self, scheme, host):
+        if self.closed_at != _Connections.closings:
+            # close_connections has closed these already.
+            self.open.clear()
+            self.closed_at = _Connections.closings
+        if (scheme, host) not in self.open:
+            kind = (http.client.HTTPSConnection if scheme == 'https' else
+                    http.client.HTTPConnection)
+            connection = kind(host, timeout=60)
+            with _Connections.lock:
+                _Connections.everywhere.add(connection)
+            self.open[scheme, host] = connection
+        return self.open[scheme, host]
+
+    def drop(self, scheme, host):
+        connection = self.open.pop((scheme, host), None)
+        if connection is not None:
+            with _Connections.lock:
+                _Connections.everywhere.discard(connection)
+            connection.close()
+
+_connections = _Connections()
+
+def close_connections():
+    """Closes the kept-alive connections of every thread. Nothing
+    should be downloading while this runs."""
+    with _Connections.lock:
+        connections = list(_Connections.everywhere)
+        _Connections.everywhere.clear()
+        _Connections.closings += 1
+    for connection in connections:
+        connection.close()
+
+# Most redirects to follow for one request.
+max_redirects = 5
+
+def fetch_url(url, path, chunk_size=1 << 20):
+    """
+    Downloads url to path. The bytes go to path + '.part' and it's
+    renamed to path once complete, so path is never a partial file. If
+    a download was interrupted, the '.part' file is kept and only the
+    rest of the file is requested next time (with a Range header).
+    """
+    partial_path = path + '.part'
+    response, have = _request_rest(url, partial_path)
+    if response is not None:
+        length = response.getheader('Content-Length')
+        with open(partial_path, 'ab' if have else 'wb') as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+        if (length is not None and
+                os.path.getsize(partial_path) != have + int(length)):
+            _drop_connection(response)
+            raise urllib.error.ContentTooShortError(
+                    f"Download of '{url}' was cut short.", None)
+
+    os.replace(partial_path, path)
+
+def _request(url, headers):
+    """GETs url on a kept-alive connection, following up to
+    max_redirects redirects. Returns the response, with the URL it came
+    from as response.url."""
+    for hop in range(max_redirects + 1):
+        response = _request_once(url, headers)
+        location = response.getheader('Location')
+        if response.status not in (301, 302, 303, 307, 308) or not location:
+            response.url = url
+            return response
+        response.read()
+        # Location can be relative. If it's on another host, the
+        # request goes out on a connection to that host.
+        url = urllib.parse.urljoin(url, location)
+    raise urllib.error.HTTPError(url, response.status,
+            f'More than {max_redirects} redirects.', response.headers, None)
+
+def _request_once(url, headers):
+    parts = urllib.parse.urlsplit(url)
+    target = parts.path + (f'?{parts.query}' if parts.query else '')
+    # A kept-alive connection may have been closed by the server since
+    # it was last used. Try again once on a new connection.
+    for attempt in range(2):
+        connection = _connections.get(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', target, headers=headers)
+            return connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            _connections.drop(parts.scheme, parts.netloc)
+            if attempt == 1:
+                raise
+
+def _drop_connection(response):
+    """Drops the connection response came on, which can't be used
+    again if response wasn't read to the end."""
+    parts = urllib.parse.urlsplit(response.url)
+    _connections.drop(parts.scheme, parts.netloc)
+
+def _request_rest(url, partial_path):
+    """Requests the part of url not already in partial_path. Returns
+    the response (200 for the whole file, 206 for the rest) and the
+    number of bytes of partial_path to keep. The response is None if
+    partial_path is already the whole file."""
+    have = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    response = _request(url, {'Range' : f'bytes={have}-'} if have else {})
+    if response.status == 404:
+        response.read()
+        raise ValueError(f"File '{url}' does not exist.")
+    elif response.status == 416:
+        # Nothing past what we have. Either the partial file is whole,
+        # or it's not the file on the server anymore.
+        response.read()
+        total = response.getheader('Content-Range', '').split('/')[-1]
+        if total == str(have):
+            return None, have
+        os.remove(partial_path)
+        return _request_rest(url, partial_path)
+    elif response.status not in (200, 206):
+        response.read()
+        raise urllib.error.HTTPError(url, response.status, response.reason,
+                                     response.headers, None)
+    # A server that ignores Range sends everything with a 200.
+    return response, (have if response.status == 206 else 0)
+
+class _TeeReader:
+    """Reads the first `have` bytes of the file `partial`, then from
+    response, appending what it reads from response to partial."""
+    def __init__(self, partial, have, response):
+        self.prefix = open(partial, 'rb') if have else None
+        self.prefix_left = have
+        self.out = open(partial, 'ab' if have else 'wb')
+        self.response = response
+
+    def read(self, size):
+        data = b''
+        if self.prefix_left:
+            data = self.prefix.read(min(size, self.prefix_left))
+            self.prefix_left -= len(data)
+        if len(data) < size:
+            more = self.response.read(size - len(data))
+            self.out.write(more)
+            data += more
+        return data
+
+    def close(self):
+        if self.prefix is not None:
+            self.prefix.close()
+        self.out.close()
+
+def stream_orbit_records(number, filename='file_15', version=None):
+    """
+    Interprets the logical records of an orbit's file as they arrive
+    from the mirror, rather than after the whole file is downloaded.
+    The file is saved as it's read, just as get_orbit_file_path would.
+    If the file is already on this machine, it's read from there.
+
+    If the records aren't all read, what was read is kept, and the
+    next download of the file carries on from there. Yields records as
+    f_bidr.iter_logical_records does.
+    """
+    if version is None:
+        version = len(orbits[number])
+    local_path = gen_local_path(number, version, filename)
+    if _have_local_file(number, version, filename):
+        yield from f_bidr.iter_logical_records(local_path)
+        return
+    catalog = local_catalog()
+
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    url = gen_url(number, version, filename)
+    partial_path = local_path + '.part'
+    response, have = _request_rest(url, partial_path)
+    if response is not None:
+        length = response.getheader('Content-Length')
+        reader = _TeeReader(partial_path, have, response)
+        finished = False
+        try:
+            yield from f_bidr.iter_logical_records_from_stream(reader)
+            # Anything after the records still belongs in the file.
+            while reader.read(1 << 20):
+                pass
+            finished = True
+        finally:
+            reader.close()
+            if not finished:
+                _drop_connection(response)
+        if (length is not None and
+                os.path.getsize(partial_path) != have + int(length)):
+            raise urllib.error.ContentTooShortError(
+                    f"Download of '{url}' was cut short.", None)
+        os.replace(partial_path, local_path)
+        catalog.add(number, version, filename, local_path)
+    else:
+        os.replace(partial_path, local_path)
+        catalog.add(number, version, filename, local_path)
+        yield from f_bidr.iter_logical_records(local_path)
+
 def download_orbit_file(number, version, filename):
     """Fetch particular file from internet mirror."""
     url = gen_url(number, version, filename)
     path = gen_local_path(number, version, filename)
     try: 
-        local_file, headers = urllib.request.urlretrieve(url)
-        shutil.move(local_file, path)
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            raise ValueError(f"File '{url}' does not exist.")
-    except urllib.error.URLError as e:
-        print("Something likely wrong with internet connection.")
+        fetch_url(url, path)
+    except OSError as e:
+        print(f"Couldn't download '{url}': {e}")
         raise e
 
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class LocalCatalog:
+    """
+    A SQLite database of the orbit files downloaded to this machine:
+    the size, sha256 checksum and download time of each, and how many
+    logical records (and image records) it has. Looking up many files
+    is one query, rather than a stat per file.
+
+    path is the database file. Safe to use from several threads.
+    """
+    columns = ['orbit', 'version', 'filename', 'size', 'sha256',
+               'downloaded', 'records', 'image_records']
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    orbit INTEGER NOT NULL,
+                    version INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    downloaded REAL NOT NULL,
+                    records INTEGER NOT NULL,
+                    image_records INTEGER NOT NULL,
+                    PRIMARY KEY (orbit, version, filename))''')
+
+    def _select(self, where, parameters):
+        with self._lock:
+            rows = self._db.execute(
+                    f"SELECT {', '.join(self.columns)} FROM files {where}",
+                    parameters).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def get(self, number, version, filename):
+        """The entry of a file as a dict, or None if it's not known."""
+        rows = self._select('WHERE orbit = ? AND version = ? AND filename = ?',
+                            (number, version, filename.upper()))
+        return rows[0] if rows else None
+
+    def entries(self, filename=None):
+        """Every entry (for one filename, if given), by (orbit, version,
+        filename)."""
+        rows = (self._select('', ()) if filename is None else
+                self._select('WHERE filename = ?', (filename.upper(),)))
+        return {(r['orbit'], r['version'], r['filename']) : r for r in rows}
+
+    def add(self, number, version, filename, path, downloaded=None):
+        """Records the file at path as the file of an orbit version."""
+        index = f_bidr.load_record_index(path)
+        image_records = int(np.isin(index['data_class'],
+                                    f_bidr.image_data_classes).sum())
+        entry = (number, version, filename.upper(), os.path.getsize(path),
+                 file_sha256(path), time.time() if downloaded is None else downloaded,
+                 len(index), image_records)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             entry)
+
+    def remove(self, number, version, filename):
+        with self._lock, self._db:
+            self._db.execute(
+                    'DELETE FROM files WHERE orbit = ? AND version = ? AND filename = ?',
+                    (number, version, filename.upper()))
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def local_catalog():
+    """The LocalCatalog of the files under data_root."""
+    path = os.path.join(data_root, 'catalog.sqlite')
+    with _catalogs_lock:
+        if path not in _catalogs:
+            _catalogs[path] = LocalCatalog(path)
+        return _catalogs[path]
+
+class _TooBig(Exception):
+    """An entry bigger than a whole RecordCache."""
+
+class RecordCache:
+    """
+    The records of files as read_logical_records gives them, kept on
+    disk so that files aren't interpreted again. An entry is keyed by
+    the sha256 checksum of a file and f_bidr.logical_record_fingerprint,
+    so entries from before a change to logical_record are never used,
+    and are removed when the next entry is added. Once the entries
+    take more than max_bytes, the least recently used are removed.
+
+    directory holds a SQLite database of the entries (and of the
+    checksums of files, by size and modification time), and a pickle
+    per entry. Safe to use from several threads.
+    """
+    def __init__(self, directory, max_bytes=8 << 30):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'entries.sqlite'),
+                                   timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    used REAL NOT NULL)''')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS checksums (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL)''')
+
+    def checksum(self, path):
+        """The sha256 of the file at path. Only worked out again if the
+        file's size or modification time has changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._db.execute(
+                    'SELECT sha256 FROM checksums WHERE path = ? AND size = ? AND mtime = ?',
+                    (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+        sha256 = file_sha256(path)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)',
+                             (path, stat.st_size, stat.st_mtime_ns, sha256))
+        return sha256
+
+    def key(self, path):
+        return f'{self.checksum(path)}-{f_bidr.logical_record_fingerprint()}'
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, path):
+        """The cached records of the file at path, or None."""
+        key = self.key(path)
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                records = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            return None
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                             (key, os.path.getsize(self._entry_path(key)),
+                              time.time()))
+        return records
+
+    def put(self, path, records):
+        """Caches records as the records of the file at path."""
+        key = self.key(path)
+        try:
+            with f_bidr.atomic_write(self._entry_path(key)) as f:
+                pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+                if size > self.max_bytes:
+                    raise _TooBig()
+        except _TooBig:
+            return
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                             (key, size, time.time()))
+        self.evict()
+
+    def evict(self):
+        """Removes the entries of other schemas, then the least
+        recently used entries until the rest fit in max_bytes."""
+        fingerprint = f_bidr.logical_record_fingerprint()
+        with self._lock:
+            rows = self._db.execute(
+                    'SELECT key, size FROM entries ORDER BY used DESC').fetchall()
+        total, removed = 0, []
+        for key, size in rows:
+            if key.endswith(fingerprint) and total + size <= self.max_bytes:
+                total += size
+            else:
+                removed.append(key)
+        for key in removed:
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM entries WHERE key = ?',
+                                 [(key,) for key in removed])
+
+    def size(self):
+        """The bytes taken by the entries."""
+        with self._lock:
+            return self._db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def read(self, path, number=None):
+        """read_logical_records(path, number), from the cache if it can
+        be. Only whole files are cached, so if number is given and the
+        file isn't cached, it's read as usual."""
+        records = self.get(path)
+        if records is None:
+            if number is not None:
+                return f_bidr.read_logical_records(path, number)
+            records = f_bidr.read_logical_records(path)
+            self.put(path, records)
+        return records if number is None else records[:number]
+
+# The size limit of record_cache().
+record_cache_max_bytes = 8 << 30
+_record_caches = {}
+
+def record_cache():
+    """The RecordCache under data_root."""
+    directory = os.path.join(data_root, 'record-cache')
+    with _catalogs_lock:
+        if directory not in _record_caches:
+            _record_caches[directory] = RecordCache(directory,
+                                                    record_cache_max_bytes)
+        cache = _record_caches[directory]
+    cache.max_bytes = record_cache_max_bytes
+    return cache
+
+def read_cached_records(path, number=None):
+    """read_logical_records for files, through record_cache(). Used
+    only when asked for, as by process_file(..., cache=True): a first
+    reading costs a hash of the file and pickling every record."""
+    return record_cache().read(path, number)
+
+def file_is_complete(path):
+    """Whether a file looks whole. For F-BIDR files, the last logical
+    record must end where the file does. Other files can't be told
+    apart from truncated ones."""
+    index = f_bidr.load_record_index(path)
+    if len(index) == 0:
+        # Unless it's an F-BIDR file cut inside its first record.
+        with open(path, 'rb') as f:
+            first = f.read(9)
+        return not (first and b'NJPL1I000'.startswith(first))
+    return int(index['offset'][-1] + index['length'][-1]) == os.path.getsize(path)
+
+def _have_local_file(number, version, filename):
+    """Whether the file is on this machine, whole. A file in the
+    catalog must still be the size it was when downloaded. One that
+    isn't in it (downloaded before the catalog was kept) is added to
+    it, if it looks whole."""
+    local_path = gen_local_path(number, version, filename)
+    catalog = local_catalog()
+    entry = catalog.get(number, version, filename)
+    if entry is not None:
+        if (os.path.exists(local_path) and
+                os.path.getsize(local_path) == entry['size']):
+            return True
+        catalog.remove(number, version, filename)
+    elif file_exists(number, version, filename):
+        if file_is_complete(local_path):
+            catalog.add(number, version, filename, local_path,
+                        os.path.getmtime(local_path))
+            return True
+    return False
+
 def get_orbit_file_path(number, filename, version=None):
-    """Download file if need be and return file's path on local machine."""
+    """Download file if need be and return file's path on local machine.
+    A file that's been cut short, or isn't the size it was when
+    downloaded, is downloaded again."""
     # Use latest version if none given
     if version is None:
         version = len(orbits[number])
     local_path = gen_local_path(number, version, filename)
+    if _have_local_file(number, version, filename):
+        return local_path
+
+    if os.path.exists(local_path):
+        os.remove(local_path)
     orbit_dir = os.path.dirname(local_path)
-    header = None
-    if not os.path.exists(orbit_dir):
-        os.makedirs(orbit_dir)
-    if not file_exists(number, version, filename):
-        download_orbit_file(number, version, filename)
+    # Other threads may be making the same directory.
+    os.makedirs(orbit_dir, exist_ok=True)
+    download_orbit_file(number, version, filename)
+    local_catalog().add(number, version, filename, local_path)
     return local_path
 
-def download_all_orbit_files(filename):
-    # I'm not raising any errors here because some label files aren't
-    # present in every fbidr. There's no way of knowing ahead of time.
-    for orbit in orbits.keys():
-        for version in range(len(orbits[orbit])):
-            try:
-                get_orbit_file_path(orbit, filename, version + 1)
-            except ValueError as e:
-                print(f'{orbits[orbit][version]}: {e.args[0]}')
+def get_orbit_file_paths(numbers, filename, version=None):
+    """get_orbit_file_path for many orbits. The files in the catalog
+    are found with one query and aren't looked at on disk; see
+    verify_orbit_files to check them."""
+    entries = local_catalog().entries(filename)
+    paths = []
+    for number in numbers:
+        number_version = len(orbits[number]) if version is None else version
+        if (number, number_version, filename.upper()) in entries:
+            paths.append(gen_local_path(number, number_version, filename))
+        else:
+            paths.append(get_orbit_file_path(number, filename, number_version))
+    return paths
+
+def verify_orbit_files(filename=None, full=False):
+    """Checks the size (and with full, the checksum) of every file in
+    the catalog against the file on disk, and downloads again the ones
+    which are missing or don't match. Returns the (orbit, version,
+    filename) of those."""
+    catalog = local_catalog()
+    refetched = []
+    for (number, version, name), entry in catalog.entries(filename).items():
+        path = gen_local_path(number, version, name)
+        good = os.path.exists(path) and os.path.getsize(path) == entry['size']
+        if good and full:
+            good = file_sha256(path) == entry['sha256']
+        if not good:
+            catalog.remove(number, version, name)
+            if os.path.exists(path):
+                os.remove(path)
+            get_orbit_file_path(number, name, version)
+            refetched.append((number, version, name))
+    return refetched
+
+def download_all_orbit_files(filename, numbers=None, workers=8):
+    """Downloads the file from every version of each orbit in numbers
+    (by default, all orbits) that isn't on this machine yet, up to
+    workers downloads at once."""
+    numbers = orbits.keys() if numbers is None else numbers
+    jobs = [(orbit, version + 1) for orbit in numbers
+            for version in range(len(orbits[orbit]))]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = {executor.submit(get_orbit_file_path, orbit, filename,
+                                       version) : (orbit, version)
+                       for orbit, version in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                orbit, version = futures[future]
+                # I'm not raising any errors here because some label
+                # files aren't present in every fbidr. There's no way
+                # of knowing ahead of time.
+                try:
+                    future.result()
+                except ValueError as e:
+                    print(f'{orbits[orbit][version - 1]}: {e.args[0]}')
+    finally:
+        # The pool's threads are gone, but their connections aren't.
+        close_connections()
+
+# One row per image record of the orbits in a SpatialIndex.
+spatial_record_dtype = np.dtype([
+    ('orbit', '<u2'),
+    ('version', 'u1'),
+    ('offset', '<i8'),
+    ('reference_lat', '<f8'),
+    ('reference_lon', '<f8'),
+])
+
+class SpatialIndex:
+    """
+    Finds image records by the latitude and longitude of their
+    reference points, across orbits. Records are bucketed in a grid of
+    cell_size degree cells, sorted by cell, so that a query only looks
+    at the records in the cells it covers.
+
+    records, numpy.ndarray : Of spatial_record_dtype. Longitudes are
+        taken to be degrees east, any multiple of 360 apart is the
+        same.
+    cell_size, float : The height and width of a grid cell in degrees.
+    """
+    def __init__(self, records, cell_size=1.0):
+        self.cell_size = cell_size
+        self.rows = int(np.ceil(180 / cell_size))
+        self.columns = int(np.ceil(360 / cell_size))
+        cells = self._cells(records['reference_lat'], records['reference_lon'])
+        order = np.argsort(cells, kind='stable')
+        self.records = records[order]
+        # Records of cell i are self.records[starts[i]:starts[i + 1]].
+        self.starts = np.searchsorted(cells[order],
+                                      np.arange(self.rows * self.columns + 1))
+
+    def _row(self, lat):
+        return np.clip(np.floor((np.asarray(lat) + 90) / self.cell_size),
+                       0, self.rows - 1).astype(np.int64)
+
+    def _column(self, lon):
+        return np.clip(np.floor(np.mod(lon, 360) / self.cell_size),
+                       0, self.columns - 1).astype(np.int64)
+
+    def _cells(self, lat, lon):
+        return self._row(lat) * self.columns + self._column(lon)
+
+    def __len__(self):
+        return len(self.records)
+
+    def query(self, lat_min, lat_max, lon_min, lon_max):
+        """Returns the records whose reference points are within the
+        bounds (inclusive). If lon_min is east of lon_max, the bounds
+        wrap around 360 degrees, eg 350 to 10 or 170 to -170. Bounds
+        360 or more degrees apart, like 0 to 360 or -180 to 180, take
+        in every longitude."""
+        width = lon_max - lon_min
+        if width < 0:
+            width = width % 360
+        start = lon_min % 360
+        end = start + width
+        if width >= 360:
+            column_ranges = [(0, self.columns - 1)]
+        elif end < 360:
+            column_ranges = [(self._column(start), self._column(end))]
+        else:
+            # Crosses 360, so it's two runs of columns.
+            column_ranges = [(self._column(start), self.columns - 1),
+                             (0, self._column(end - 360))]
+
+        pieces = []
+        for row in range(self._row(lat_min), self._row(lat_max) + 1):
+            for first, last in column_ranges:
+                # Cells in a row are next to each other.
+                pieces.append(self.records[
+                    self.starts[row * self.columns + first]:
+                    self.starts[row * self.columns + last + 1]])
+        found = np.concatenate(pieces) if pieces else self.records[:0]
+
+        lat, lon = found['reference_lat'], np.mod(found['reference_lon'], 360)
+        inside = (lat_min <= lat) & (lat <= lat_max)
+        if width >= 360:
+            pass
+        elif end < 360:
+            inside &= (start <= lon) & (lon <= end)
+        else:
+            inside &= (start <= lon) | (lon <= end - 360)
+        return found[inside]
+
+    def save(self, path):
+        with f_bidr.atomic_write(path) as f:
+            np.savez(f, records=self.records, cell_size=self.cell_size)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as saved:
+            return SpatialIndex(saved['records'], float(saved['cell_size']))
+
+def _orbit_files(filename, download, numbers=None):
+    """Yields (number, version, path) of the file of every version of
+    the orbits numbers (all orbits if None). If download is False,
+    only files already on this machine are yielded. Otherwise files
+    are fetched as need be."""
+    for number in (orbits.keys() if numbers is None else numbers):
+        for version in range(1, len(orbits[number]) + 1):
+            if download:
+                try:
+                    path = get_orbit_file_path(number, filename, version)
+                except ValueError as e:
+                    print(f'{orbits[number][version - 1]}: {e.args[0]}')
+                    continue
+            elif file_exists(number, version, filename):
+                path = gen_local_path(number, version, filename)
+            else:
+                continue
+            yield number, version, path
+
+def spatial_index_path(filename='file_15'):
+    return os.path.join(data_root, f'spatial-index-{filename.upper()}.npz')
+
+def build_spatial_index(filename='file_15', download=False, cell_size=1.0):
+    """
+    Builds a SpatialIndex of the image records of the file (eg
+    FILE_15) of every orbit and version, and saves it under data_root
+    (see spatial_index_path). Uses the record index of each file (see
+    f_bidr.load_record_index), so files are only scanned the first
+    time.
+
+    - download: If False, only files already on this machine are
+      indexed. Otherwise files are fetched as need be.
+    """
+    tables = []
+    for number, version, path in _orbit_files(filename, download):
+        index = f_bidr.load_record_index(path)
+        index = index[np.isin(index['data_class'], f_bidr.image_data_classes)]
+        table = np.zeros(len(index), dtype=spatial_record_dtype)
+        table['orbit'] = number
+        table['version'] = version
+        for name in ['offset', 'reference_lat', 'reference_lon']:
+            table[name] = index[name]
+        tables.append(table)
+
+    records = (np.concatenate(tables) if tables else
+               np.zeros(0, dtype=spatial_record_dtype))
+    spatial_index = SpatialIndex(records, cell_size)
+    os.makedirs(data_root, exist_ok=True)
+    spatial_index.save(spatial_index_path(filename))
+    return spatial_index
+
+def load_spatial_index(filename='file_15'):
+    """The SpatialIndex saved by build_spatial_index."""
+    return SpatialIndex.load(spatial_index_path(filename))
+
+def read_region_records(spatial_index, lat_min, lat_max, lon_min, lon_max,
+                        filename='file_15'):
+    """Interprets just the records that spatial_index finds within the
+    bounds (see SpatialIndex.query), rather than whole orbits. Yields
+    (orbit, version, record) with record as from
+    f_bidr.read_logical_records."""
+    sources = {}
+    for row in spatial_index.query(lat_min, lat_max, lon_min, lon_max):
+        number, version = int(row['orbit']), int(row['version'])
+        if (number, version) not in sources:
+            sources[number, version] = f_bidr.open_source(
+                    gen_local_path(number, version, filename))
+        yield number, version, f_bidr.read_logical_record_at(
+                sources[number, version], int(row['offset']))
+
+# The groups of records that ColumnStore keeps. The data classes of a
+# group are interpreted alike (see f_bidr.read_record_columns).
+column_groups = {
+    'per-orbit' : [1],
+    'processing' : [4, 68],
+    'image-labels' : f_bidr.image_data_classes,
+}
+
+class ColumnStore:
+    """
+    The non-image fields of the records of many orbits, kept as
+    columns (see f_bidr.read_record_columns), so that fields can be
+    loaded without interpreting files again.
+
+    There's a row group per orbit file per group of column_groups, at
+    directory/<group>/<orbit>-<version>.npz. Each column is compressed
+    on its own within it, so loading some columns reads only those.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, group, number, version):
+        return os.path.join(self.directory, group, f'{number}-{version}.npz')
+
+    def write(self, number, version, source):
+        """Saves the row groups of an orbit file. source is as for
+        f_bidr.read_record_columns."""
+        source = f_bidr.open_source(source)
+        offsets = np.array([start for start, end in
+                            f_bidr.logical_record_spans(source)], dtype=np.int64)
+        for group, classes in column_groups.items():
+            columns = f_bidr.read_record_columns(source, classes, offsets)
+            path = self.path(group, number, version)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with f_bidr.atomic_write(path) as f:
+                np.savez_compressed(f, **columns)
+
+    def row_groups(self, group):
+        """The (number, version) of the saved row groups of group, in
+        order."""
+        directory = os.path.join(self.directory, group)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(tuple(int(part) for part in name[:-len('.npz')].split('-'))
+                      for name in os.listdir(directory) if name.endswith('.npz'))
+
+    def columns(self, group):
+        """The names of the columns of group."""
+        row_groups = self.row_groups(group)
+        if not row_groups:
+            return []
+        with np.load(self.path(group, *row_groups[0])) as saved:
+            return list(saved.files)
+
+    def read(self, group, columns=None, numbers=None):
+        """
+        Loads columns (all of them if None) of group, with the rows of
+        every saved orbit in numbers (all of them if None) one after
+        the other. A version column tells apart the versions of an
+        orbit.
+        """
+        row_groups = [(number, version) for number, version in
+                      self.row_groups(group)
+                      if numbers is None or number in numbers]
+        names = self.columns(group) if columns is None else list(columns)
+        parts = {name : [] for name in names}
+        versions = []
+        for number, version in row_groups:
+            with np.load(self.path(group, number, version)) as saved:
+                for name in names:
+                    parts[name].append(saved[name])
+            versions.append(np.full(len(parts[names[0]][-1]) if names else 0,
+                                    version, dtype=np.int64))
+        result = {name : np.concatenate(arrays) for name, arrays in
+                  parts.items() if arrays}
+        if versions:
+            result['version'] = np.concatenate(versions)
+        return result
+
+def columns_path(filename='file_15'):
+    return os.path.join(data_root, f'columns-{filename.upper()}')
+
+def export_columns(filename='file_15', numbers=None, download=False,
+                   overwrite=False):
+    """
+    Saves the non-image fields of the file (eg FILE_15) of every
+    version of the orbits numbers (all orbits if None) in a ColumnStore
+    under data_root (see columns_path), and returns it.
+
+    - download: If False, only files already on this machine are
+      exported. Otherwise files are fetched as need be.
+    - overwrite: If False, files with row groups already saved are
+      skipped.
+    """
+    store = ColumnStore(columns_path(filename))
+    for number, version, path in _orbit_files(filename, download, numbers):
+        saved = all(os.path.exists(store.path(group, number, version))
+                    for group in column_groups)
+        if overwrite or not saved:
+            store.write(number, version, path)
+    return store
+
+def load_columns(group, columns=None, numbers=None, filename='file_15'):
+    """Loads columns of the ColumnStore saved by export_columns. See
+    ColumnStore.read."""
+    return ColumnStore(columns_path(filename)).read(group, columns, numbers)
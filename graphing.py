@@ -1,8 +1,6 @@
-import matplotlib.pyplot as plt
 from f_bidr import *
-from f_bidr_data import get_orbit_file_path as orbit
+from f_bidr_data import get_orbit_file_path as orbit, read_cached_records
 from images import *
-import itertools
 
 import numpy as np
 
@@ -17,13 +15,18 @@ import numpy as np
 
 def get(records, *names):
     """For extracting per-record information from a list of orbits.
-    Returns a list of data, or list of lists of data."""
-    outputs = []
-    for name in names:
-        if callable(name):
-            outputs.append([name(r) for r in records])
-        else:
-            outputs.append([r[name] for r in records])
+    Returns a list of data, or list of lists of data. records can be
+    any iterable, like iter_logical_records, and is only gone through
+    once. records can also be the columns of read_record_columns, in
+    which case the columns themselves are returned."""
+    if isinstance(records, dict):
+        outputs = [name(records) if callable(name) else records[name]
+                   for name in names]
+        return outputs[0] if len(names) == 1 else outputs
+    outputs = [[] for name in names]
+    for r in records:
+        for output, name in zip(outputs, names):
+            output.append(name(r) if callable(name) else r[name])
     if len(names) == 1:
         return outputs[0]
     else:
@@ -37,6 +40,9 @@ def gets(record_iter, name):
     return [get(lst, name) for lst in record_iter]
 
 def graph(records, *names, **axargs):
+    # Importing pyplot reads matplotlib's settings and font cache, so
+    # it's put off until something is graphed.
+    import matplotlib.pyplot as plt
     stuff = get(records, *names)
     if len(names) == 1:
         plt.scatter(range(len(stuff)), stuff)
@@ -55,9 +61,29 @@ def find_first(lst, test):
     for i in range(len(lst)):
         if test(lst[i]): 
             return i
-def read_orbit(*args, num_records=None):
+def read_orbit(*args, num_records=None, cache=False):
+    """Records of an orbit. With cache, kept in the record cache after
+    the first time (see f_bidr_data.RecordCache), for orbits looked at
+    again and again; the first time costs more than reading."""
+    if cache:
+        return read_cached_records(orbit(*args), num_records)
     return read_logical_records(orbit(*args), num_records)
 
+def iter_orbit(*args, start=None, stop=None):
+    return iter_logical_records(orbit(*args), start, stop)
+
+def open_orbit(*args, cache_size=1024):
+    """Records of an orbit, interpreted as they're looked at. Works
+    with find_first, get and measure_overlap."""
+    return LogicalRecordFile(orbit(*args), cache_size)
+
+def orbit_columns(*args, data_class=image_data_classes):
+    """The records of an orbit of one data class (or data classes
+    interpreted alike), as columns. See read_record_columns. Works with
+    get, graph and measure_overlap."""
+    path = orbit(*args)
+    return read_record_columns(path, data_class, load_record_index(path)['offset'])
+
 def measure_overlap(records):
     line_offsets = np.array(get(records, 'reference_offset_lines'))
     heights = np.array(get(records, 'line_count'))
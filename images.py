@@ -1,68 +1,211 @@
-from f_bidr import logical_record, count_logical_recs, read_logical_records
-from f_bidr_data import get_orbit_file_path as orbit
+from f_bidr import (read_logical_records, image_data_classes, ImageRecords,
+        read_image_records, load_record_index)
+from f_bidr_data import get_orbit_file_path as orbit, read_cached_records
+
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    # Not on Windows. process_orbits can't have a memory_budget there.
+    resource = None
 
 import numpy as np
-import numpy.ma as ma
 import imageio
 
 # NOTE: File 15 has more than one logical record. It's a series of
 # logical records.
 selected_orbits = [376, 382, 384, 386, 390]
-selected_orbits = [orbit(i, "file_15") for i in selected_orbits]
 
 def multiple_orbits():
     records = []
 
-    with open(orb376, 'rb') as f:
-        contents = f.read()
-        records += read_logical_records(contents, 250)
-
-    with open(orb382, 'rb') as f:
-        contents = f.read()
-        records += read_logical_records(contents, 250)
-
-    with open(orb384, 'rb') as f:
-        contents = f.read()
-        records += read_logical_records(contents, 250)
-
-    with open(orb386, 'rb') as f:
-        contents = f.read()
-        records += read_logical_records(contents, 250)
-
-    with open(orb390, 'rb') as f:
-        contents = f.read()
-        records += read_logical_records(contents, 250)
+    # Files are fetched here rather than on import.
+    for number in selected_orbits:
+        records += read_logical_records(orbit(number, "file_15"), 250)
 
     biggun = image_stitch(records, None, None)
     return biggun, records
 
 
-def process_file(filepath, savepath, slices=3):
-    with open(filepath, 'rb') as f:
-        contents = f.read()
-        #records = read_logical_records(contents, 250)
-        records = read_logical_records(contents)
+def process_file(filepath, savepath, slices=3, cache=False):
+    """Stitches the image records of a file and writes it out as by
+    write_slices. With cache, the records are read through the record
+    cache (see f_bidr_data.RecordCache), which is only worth it for
+    files read over and over: the first reading hashes and pickles the
+    whole file."""
+    #records = read_logical_records(filepath, 250)
+    if cache:
+        records = read_cached_records(filepath)
+    else:
+        records = read_logical_records(filepath)
 
     #biggun = image_stitch(records, None, None)
     #imageio.imwrite(savepath, biggun)
 
+    records = [r for r in records if r['type'] in image_data_classes]
     biggun = image_stitch(records, None, None)
-    height = biggun.shape[0]
+    write_slices(biggun, savepath, slices)
+
+def write_slices(picture, savepath, slices=3):
+    """Writes picture as slices horizontal pieces, named
+    {count}-{savepath}, from the top down."""
+    directory, filename = os.path.split(savepath)
+    height = picture.shape[0]
     divide_into = slices
     start = 0
     count = 0
-    piece_size = height // divide_into
+    piece_size = max(1, height // divide_into)
     while start < height:
         end = start + piece_size
-        imageio.imwrite(f'{count}-{savepath}', biggun[start:end])
+        imageio.imwrite(os.path.join(directory, f'{count}-{filename}'),
+                        picture[start:end])
         start = end
         count += 1
 
+def _process_orbit(number, savepath, slices, memory_budget):
+    """Worker for process_orbits. Returns the time taken by each stage,
+    or the error which stopped the orbit."""
+    report = {'orbit' : number, 'error' : None}
+    stage_start = time.perf_counter()
+    def finished(stage):
+        nonlocal stage_start
+        now = time.perf_counter()
+        report[stage] = now - stage_start
+        stage_start = now
+
+    limit = None
+    try:
+        if memory_budget is not None:
+            if resource is None:
+                raise ValueError('memory_budget needs the resource module.')
+            limit = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_budget, limit[1]))
+        filepath = orbit(number, 'file_15')
+        finished('fetch')
+        records = [r for r in read_logical_records(filepath)
+                   if r['type'] in image_data_classes]
+        finished('decode')
+        picture = image_stitch(records, None, None)
+        del records
+        finished('stitch')
+        write_slices(picture, savepath.format(orbit=number), slices)
+        finished('write')
+    except Exception as e:
+        report['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        # The worker goes on to other orbits, which get their own
+        # budget.
+        if limit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, limit)
+    return report
+
+def process_orbits(numbers, savepath='orbit-{orbit}.png', slices=3,
+                   workers=None, memory_budget=None):
+    """
+    Renders the FILE_15 of each orbit in numbers, in a pool of worker
+    processes. Each orbit is fetched (see get_orbit_file_path),
+    decoded, stitched, and written out as by process_file.
+
+    - savepath is formatted with the orbit number, as in
+      savepath.format(orbit=376).
+    - workers is the number of orbits processed at once, by default
+      one per cpu.
+    - memory_budget is the most memory (in bytes) a worker may use for
+      an orbit. An orbit which needs more fails with a MemoryError
+      (or an OSError, if it's memory mapping the FILE_15 that goes
+      over) rather than pushing the machine into swap. Unix only. It caps
+      the worker's whole address space (RLIMIT_AS), not just what the
+      orbit allocates: the interpreter and its libraries, and the
+      FILE_15, which is memory mapped, count toward it too. So it has
+      to be the size of the FILE_15 plus a few hundred MB at the very
+      least.
+
+    Returns a report per orbit, in the order of numbers, with the
+    seconds taken by each stage ('fetch', 'decode', 'stitch',
+    'write') and 'error', the error which stopped the orbit if any.
+    An orbit that fails doesn't stop the others.
+    """
+    reports = {}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(_process_orbit, number, savepath,
+                                   slices, memory_budget) : number
+                   for number in numbers}
+        for future in concurrent.futures.as_completed(futures):
+            report = future.result()
+            reports[report['orbit']] = report
+            stages = ', '.join(f'{stage} {report[stage]:.1f}s'
+                    for stage in ['fetch', 'decode', 'stitch', 'write']
+                    if stage in report)
+            print(f"Orbit {report['orbit']}: {stages}"
+                  f"{'' if report['error'] is None else ', ' + report['error']}")
+    return [reports[number] for number in numbers]
+
 # TODO: Don't think this works for right-look images. The pointer and
 # offset are relative to the east-most pixel for those.
-def make_mask(offset, pointer, length):
-    return np.array([True]*offset + [False]*(pointer - offset) + 
-            [True]*(length - pointer))
+def valid_pixels(offsets, pointers, length):
+    """Which pixels of each line of a record are valid, as a boolean
+    array of (lines, length). offsets and pointers are the
+    offset_to_first and pointer_to_last of each line."""
+    columns = np.arange(length)
+    offsets = np.asarray(offsets)[:, None]
+    pointers = np.asarray(pointers)[:, None]
+    return (offsets <= columns) & (columns < pointers)
+
+def record_pixels(record):
+    """The pixel lines of a record from read_logical_records, as a
+    (line_count, line_length - 4) uint8 array, along with which of
+    them are valid."""
+    data = record['data']
+    length = record['line_length'] - 4
+    lines = np.frombuffer(b''.join(x['line'] for x in data), dtype=np.uint8)
+    lines = lines.reshape(len(data), length)
+    valids = valid_pixels([x['offset_to_first'] for x in data],
+                          [x['pointer_to_last'] for x in data], length)
+    return lines, valids
+
+def _stitch_pieces(records):
+    """Yields the line offset, pixel offset, pixel lines and valid
+    pixels of each record. records is a list of records from
+    read_logical_records, or ImageRecords."""
+    if isinstance(records, ImageRecords):
+        for i in range(len(records)):
+            lines = records.lines(i)
+            valids = valid_pixels(records.offset_to_first(i),
+                                  records.pointer_to_last(i), lines.shape[1])
+            row = records.header[i]
+            yield (int(row['reference_offset_lines']),
+                   int(row['reference_offset_pixels']), lines, valids)
+    else:
+        for record in records:
+            lines, valids = record_pixels(record)
+            yield (record['reference_offset_lines'],
+                   record['reference_offset_pixels'], lines, valids)
+
+def _record_columns(records, *names):
+    if isinstance(records, ImageRecords):
+        records = records.header
+    if isinstance(records, np.ndarray):
+        return [records[name].astype(np.int64) for name in names]
+    return [np.array([r[name] for r in records], dtype=np.int64)
+            for name in names]
+
+def stitch_bounds(records):
+    """The pixel offset of the left-most pixel, line offset of the top
+    line, and the height and width of the picture that records stitch
+    into. records is anything image_stitch accepts, or rows of image
+    records from a record index (see f_bidr.load_record_index)."""
+    pixel_offsets, line_offsets, line_lengths, line_counts = _record_columns(
+            records, 'reference_offset_pixels', 'reference_offset_lines',
+            'line_length', 'line_count')
+    left_most = int(pixel_offsets.min())
+    right_most = int((pixel_offsets + line_lengths).max())
+    top_most = int(line_offsets.max())
+    bottom_most = int((line_offsets - line_counts).min())
+    return left_most, top_most, top_most - bottom_most, right_most - left_most
 
 # TODO: Some files, such as MG_4002/F0382_4/FILE_13, start from a low
 # line offset and proceed to a larger one. The final product shows
@@ -86,12 +229,11 @@ def make_mask(offset, pointer, length):
 #   - height of last picture, whose 1st row is on the row of smallest
 #     offset.
 def image_stitch(records, sort_by, save_path=None):
-    pixel_offsets = [r['reference_offset_pixels'] for r in records]
-    line_offsets = [r['reference_offset_lines'] for r in records]
-    left_most = min(pixel_offsets)
-    right_most = max([r['reference_offset_pixels'] + r['line_length'] for r in records])
-    top_most = max(line_offsets)
-    bottom_most = min([r['reference_offset_lines'] - r['line_count'] for r in records])
+    """records is a list of image records from read_logical_records, or
+    ImageRecords from read_image_records."""
+    left_most, top_most, height, width = stitch_bounds(records)
+    right_most = left_most + width
+    bottom_most = top_most - height
     min_pixels = left_most
     max_lines = top_most
     #min_pixels, max_pixels = min(pixel_offsets), max(pixel_offsets)
@@ -129,8 +271,6 @@ def image_stitch(records, sort_by, save_path=None):
     #   image records between this not-last record and the last one.
     #   line offset. So this should be the last image, plus that
     #   image's height.
-    bottom_image = min(records, key=lambda r:r['reference_offset_lines'])
-    bottom_image_lines = bottom_image['line_count']
     # I know ahead of time that the last image record should have the
     # largest line offset. I wanna know the size of image that would
     # appear at the highest offset.
@@ -140,17 +280,7 @@ def image_stitch(records, sort_by, save_path=None):
     print(f'Attempting shape: {max_height}x{max_width}')
     master_picture = np.zeros((max_height, max_width), dtype=np.uint8)
     record_num = 0
-    for record in records:
-        line_length = record['line_length'] - 4
-        masked_lines = [ma.array(x['line'], dtype=np.uint8, 
-                        mask=make_mask(
-                            x['offset_to_first'], x['pointer_to_last'],
-                            line_length))
-                        for x in record['data']]
-        image = ma.stack(masked_lines, axis=0)
-        #image = np.array([x['line'] for x in record['data']], dtype=np.uint8)
-        pixel_shift = record['reference_offset_pixels']
-        line_shift = record['reference_offset_lines']
+    for line_shift, pixel_shift, image, valids in _stitch_pieces(records):
         # The 0th column is the pixel most to the left, thus
         # min_pixels should map to index 0
         height, width = image.shape
@@ -166,11 +296,286 @@ def image_stitch(records, sort_by, save_path=None):
         # line offset 0, I added max_lines.
         top = -line_shift + max_lines
         region = master_picture[top:top + height, left:left + width]
-        valids = ~image.mask
-        region[:, :][valids] = image[valids]
+        np.copyto(region, image, where=valids)
         record_num += 1
     return master_picture
 
+def extract_region(number, line_range, pixel_range, version=None,
+                   filename='file_15'):
+    """extract_region_from_file for an orbit's file (see
+    get_orbit_file_path)."""
+    return extract_region_from_file(orbit(number, filename, version),
+                                    line_range, pixel_range)
+
+def extract_region_from_file(filepath, line_range, pixel_range):
+    """
+    Stitches just the part of a file's picture in a window of line and
+    pixel offsets (the reference_offset_lines and
+    reference_offset_pixels of records). Records outside of the window
+    are never interpreted; they're picked out using the file's record
+    index (see f_bidr.load_record_index).
+
+    - line_range is (low, high), the line offsets from low up to but
+      not including high. As with image_stitch, the top row of the
+      result is the highest line offset, high - 1.
+    - pixel_range is (low, high), the pixel offsets from low up to but
+      not including high. The left column of the result is low.
+    """
+    line_low, line_high = line_range
+    pixel_low, pixel_high = pixel_range
+    index = load_record_index(filepath)
+    index = index[np.isin(index['data_class'], image_data_classes)]
+    # A record's lines go from its line offset down, its pixels from
+    # its pixel offset to the right.
+    line_offsets = index['reference_offset_lines'].astype(np.int64)
+    pixel_offsets = index['reference_offset_pixels'].astype(np.int64)
+    intersects = ((line_offsets - index['line_count'] + 1 < line_high) &
+                  (line_low <= line_offsets) &
+                  (pixel_offsets < pixel_high) &
+                  (pixel_low < pixel_offsets + index['line_length'] - 4))
+
+    picture = np.zeros((max(0, line_high - line_low),
+                        max(0, pixel_high - pixel_low)), dtype=np.uint8)
+    records = read_image_records(filepath, offsets=index['offset'][intersects])
+    for line_shift, pixel_shift, image, valids in _stitch_pieces(records):
+        top = line_high - 1 - line_shift
+        left = pixel_shift - pixel_low
+        # Clip to the window.
+        rows = slice(max(0, -top), min(image.shape[0], picture.shape[0] - top))
+        columns = slice(max(0, -left), min(image.shape[1], picture.shape[1] - left))
+        region = picture[top + rows.start:top + rows.stop,
+                         left + columns.start:left + columns.stop]
+        np.copyto(region, image[rows, columns], where=valids[rows, columns])
+    return picture
+
+class TiledMosaic:
+    """
+    A picture kept in a file on disk rather than in memory, split into
+    square tiles. Each tile is contiguous in the file, so placing a
+    record or reading a tile only touches the parts of the file under
+    it. For pictures bigger than memory, like mosaics of many orbits.
+
+    - path is the file for the tiles. It is created, or overwritten.
+    - height and width are the size of the picture in pixels.
+    - tile_size is the height and width of each tile.
+    """
+    def __init__(self, path, height, width, tile_size=1024):
+        self.height = height
+        self.width = width
+        self.tile_size = tile_size
+        self.tile_rows = -(-height // tile_size)
+        self.tile_columns = -(-width // tile_size)
+        self.tiles = np.memmap(path, dtype=np.uint8, mode='w+',
+                shape=(self.tile_rows, self.tile_columns, tile_size, tile_size))
+
+    def place(self, top, left, image, valids):
+        """Writes the valid pixels of image with its top left pixel at
+        row top and column left of the picture, one tile at a time."""
+        size = self.tile_size
+        height, width = image.shape
+        for tile_row in range(top // size, (top + height - 1) // size + 1):
+            row_start = max(top, tile_row * size)
+            row_end = min(top + height, (tile_row + 1) * size)
+            for tile_column in range(left // size, (left + width - 1) // size + 1):
+                column_start = max(left, tile_column * size)
+                column_end = min(left + width, (tile_column + 1) * size)
+                rows = slice(row_start - top, row_end - top)
+                columns = slice(column_start - left, column_end - left)
+                tile = self.tiles[tile_row, tile_column]
+                np.copyto(
+                    tile[row_start - tile_row * size:row_end - tile_row * size,
+                         column_start - tile_column * size:
+                            column_end - tile_column * size],
+                    image[rows, columns], where=valids[rows, columns])
+
+    def tile(self, row, column):
+        """The tile at tile row and column, without the parts past the
+        bottom and right edges of the picture."""
+        size = self.tile_size
+        return self.tiles[row, column,
+                          :min(size, self.height - row * size),
+                          :min(size, self.width - column * size)]
+
+    def write_tiles(self, directory, name='{row}-{column}.png'):
+        """Writes each tile as a picture in directory, one at a time."""
+        os.makedirs(directory, exist_ok=True)
+        for row in range(self.tile_rows):
+            for column in range(self.tile_columns):
+                imageio.imwrite(
+                    os.path.join(directory, name.format(row=row, column=column)),
+                    np.asarray(self.tile(row, column)))
+
+def stitch_tiled(filepaths, path, tile_size=1024):
+    """
+    Stitches the image records of each file in filepaths (like
+    FILE_15s) into a TiledMosaic at path. The size of the picture comes
+    from the files' record indexes, then records are placed one at a
+    time as they're read, so neither the records nor the picture need
+    to fit in memory.
+    """
+    left_most, top_most, height, width = _files_bounds(filepaths)
+    print(f'Attempting shape: {height}x{width}')
+    mosaic = TiledMosaic(path, height, width, tile_size)
+    _place_files(filepaths, mosaic, left_most, top_most)
+    mosaic.tiles.flush()
+    return mosaic
+
+def _files_bounds(filepaths):
+    """stitch_bounds of the image records of several files, from their
+    record indexes."""
+    indexes = [load_record_index(filepath) for filepath in filepaths]
+    image_rows = np.concatenate([index[np.isin(index['data_class'],
+                                               image_data_classes)]
+                                 for index in indexes])
+    return stitch_bounds(image_rows)
+
+def _place_files(filepaths, picture, left_most, top_most):
+    """Places the image records of each file into picture (anything
+    with a place method, like TiledMosaic), one record at a time."""
+    for filepath in filepaths:
+        for line_shift, pixel_shift, image, valids in _stitch_pieces(
+                read_image_records(filepath)):
+            picture.place(top_most - line_shift, pixel_shift - left_most,
+                          image, valids)
+
+class ImagePyramid:
+    """
+    A picture along with smaller versions of it, each half the size of
+    the last, for zooming out. Each pixel of a smaller version is the
+    mean of the pixels under it in the full picture that records
+    placed, so where records overlap, it's the pixels of the one
+    placed last that count, as in the full picture. The smaller
+    versions are worked out from the full picture a tile at a time
+    once the records are placed (see reduce).
+
+    - work_directory holds the files for the full picture (a
+      TiledMosaic), which of its pixels were placed, and the sums and
+      counts for each smaller version.
+    - height and width are the size of the full picture.
+    - tile_size is the size of the tiles. Versions are made until one
+      fits in a single tile.
+    """
+    def __init__(self, work_directory, height, width, tile_size=256):
+        self.tile_size = tile_size
+        self.full = TiledMosaic(os.path.join(work_directory, 'full'),
+                                height, width, tile_size)
+        self.placed = TiledMosaic(os.path.join(work_directory, 'placed'),
+                                  height, width, tile_size)
+        self.reduced = True
+        # (factor, sums, counts) for each smaller version, largest
+        # first.
+        self.reductions = []
+        factor = 2
+        while max(height, width) > tile_size * factor // 2:
+            shape = (-(-height // factor), -(-width // factor))
+            sums = np.memmap(os.path.join(work_directory, f'sums-{factor}'),
+                             dtype=np.uint32, mode='w+', shape=shape)
+            counts = np.memmap(os.path.join(work_directory, f'counts-{factor}'),
+                               dtype=np.uint32, mode='w+', shape=shape)
+            self.reductions.append((factor, sums, counts))
+            factor *= 2
+
+    def place(self, top, left, image, valids):
+        """Same as TiledMosaic.place. The smaller versions are out of
+        date until the next reduce."""
+        self.full.place(top, left, image, valids)
+        self.placed.place(top, left, valids, valids)
+        self.reduced = False
+
+    def reduce(self):
+        """Works out each smaller version from the pixels placed in the
+        full picture, one tile of it at a time."""
+        for factor, sums, counts in self.reductions:
+            sums[:] = 0
+            counts[:] = 0
+        size = self.tile_size
+        for tile_row in range(self.full.tile_rows):
+            for tile_column in range(self.full.tile_columns):
+                self._reduce_tile(tile_row * size, tile_column * size,
+                        np.asarray(self.full.tile(tile_row, tile_column)),
+                        np.asarray(self.placed.tile(tile_row, tile_column),
+                                   dtype=bool))
+        self.reduced = True
+
+    def _reduce_tile(self, top, left, image, valids):
+        """Adds the valid pixels of image, at row top and column left
+        of the full picture, into the means of each smaller version."""
+        height, width = image.shape
+        rows = np.arange(top, top + height)
+        columns = np.arange(left, left + width)
+        values = image[valids]
+        for factor, sums, counts in self.reductions:
+            first_row, first_column = top // factor, left // factor
+            region_rows = rows[-1] // factor - first_row + 1
+            region_columns = columns[-1] // factor - first_column + 1
+            cells = ((rows // factor - first_row)[:, None] * region_columns +
+                     (columns // factor - first_column))[valids]
+            size = region_rows * region_columns
+            region = (slice(first_row, first_row + region_rows),
+                      slice(first_column, first_column + region_columns))
+            sums[region] += np.bincount(cells, weights=values, minlength=size
+                    ).reshape(region_rows, region_columns).astype(np.uint32)
+            counts[region] += np.bincount(cells, minlength=size
+                    ).reshape(region_rows, region_columns).astype(np.uint32)
+
+    @property
+    def levels(self):
+        return len(self.reductions) + 1
+
+    def tile(self, zoom, row, column):
+        """The tile at tile row and column of a zoom level. Zoom level
+        0 is the smallest version, levels - 1 the full picture."""
+        if zoom == self.levels - 1:
+            return np.asarray(self.full.tile(row, column))
+        if not self.reduced:
+            self.reduce()
+        factor, sums, counts = self.reductions[self.levels - 2 - zoom]
+        size = self.tile_size
+        region = (slice(row * size, (row + 1) * size),
+                  slice(column * size, (column + 1) * size))
+        sums, counts = np.asarray(sums[region]), np.asarray(counts[region])
+        means = (sums + counts // 2) // np.maximum(counts, 1)
+        return means.astype(np.uint8)
+
+    def tile_counts(self, zoom):
+        """The number of tile rows and columns of a zoom level."""
+        if zoom == self.levels - 1:
+            return self.full.tile_rows, self.full.tile_columns
+        sums = self.reductions[self.levels - 2 - zoom][1]
+        return (-(-sums.shape[0] // self.tile_size),
+                -(-sums.shape[1] // self.tile_size))
+
+    def write_tiles(self, directory):
+        """Writes every tile as {zoom}/{column}/{row}.png in directory,
+        the usual layout of tiles for map viewers (z/x/y), along with
+        the size of the picture in pyramid.json."""
+        for zoom in range(self.levels):
+            tile_rows, tile_columns = self.tile_counts(zoom)
+            for column in range(tile_columns):
+                column_directory = os.path.join(directory, str(zoom), str(column))
+                os.makedirs(column_directory, exist_ok=True)
+                for row in range(tile_rows):
+                    imageio.imwrite(os.path.join(column_directory, f'{row}.png'),
+                                    self.tile(zoom, row, column))
+        with open(os.path.join(directory, 'pyramid.json'), 'w') as f:
+            json.dump({'height' : self.full.height, 'width' : self.full.width,
+                       'tile_size' : self.tile_size, 'levels' : self.levels}, f)
+
+def stitch_pyramid(filepaths, directory, tile_size=256):
+    """
+    Stitches the image records of each file in filepaths into an
+    ImagePyramid, in one pass over the records, and writes its tiles
+    to directory (see ImagePyramid.write_tiles).
+    """
+    left_most, top_most, height, width = _files_bounds(filepaths)
+    print(f'Attempting shape: {height}x{width}')
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=directory) as work_directory:
+        pyramid = ImagePyramid(work_directory, height, width, tile_size)
+        _place_files(filepaths, pyramid, left_most, top_most)
+        pyramid.write_tiles(directory)
+        del pyramid
+
 # Image questions:
 # - What's the orientation of the image lines? I know that the first
 #   pixel of each line is west-most. However, suppose that the
@@ -2,8 +2,30 @@ import unittest
 from attrs_structs import (RecordTypes as R,
         process_meta_record,
         tree_to_values,
-        Node)
+        vax_floats_to_array,
+        FixedLayout,
+        Node,
+        compile_decoder,
+        schema_fingerprint)
 import random
+import os
+import io
+import tempfile
+import threading
+import http.server
+import urllib.error
+import hashlib
+import struct
+import pickle
+import json
+
+import numpy as np
+import numpy.ma as ma
+import imageio
+
+import f_bidr
+import f_bidr_data
+import images
 
 sample_data_dir = 'sample-data'
 def translate_float(hex_string):
@@ -154,6 +176,49 @@ class FloatsTests:
 
 
 
+
+class FloatArrayTests(unittest.TestCase):
+    def randomFloats(self, length, count):
+        return bytes(random.randrange(0, 256) for x in range(length * count))
+
+    def testSinglesMatchFloat(self):
+        source = self.randomFloats(4, 2000)
+        expected = [R.Float('single')(source[i:i+4])[0]
+                    for i in range(0, len(source), 4)]
+        actual = vax_floats_to_array(source, 'single')
+        self.assertEqual(expected, actual.tolist())
+
+    def testDoublesMatchFloat(self):
+        source = self.randomFloats(8, 2000)
+        expected = [R.Float('double')(source[i:i+8])[0]
+                    for i in range(0, len(source), 8)]
+        actual = vax_floats_to_array(source, 'double')
+        self.assertEqual(expected, actual.tolist())
+
+    def testZeroExponent(self):
+        source = bytes.fromhex('0000ffff 7f80ffff')
+        self.assertEqual(vax_floats_to_array(source).tolist(), [0.0, 0.0])
+
+    def testBadLength(self):
+        with self.assertRaises(ValueError):
+            vax_floats_to_array(b'\x80\x40\x00', 'single')
+        with self.assertRaises(ValueError):
+            vax_floats_to_array(b'\x80\x40\x00\x00', 'half')
+
+    def testRecord(self):
+        source = memoryview(bytes.fromhex('80400000 60c10000 4941d00f ff'))
+        values, rest = R.FloatArray('single', 3)(source)
+        self.assertEqual(values.tolist(),
+                [R.Float('single')(source[i:])[0] for i in (0, 4, 8)])
+        self.assertEqual(bytes(rest), b'\xff')
+
+    def testShort(self):
+        # 8 bytes is two singles, but not three.
+        source = bytes.fromhex('80400000 60c10000')
+        with self.assertRaises(struct.error):
+            R.FloatArray('single', 3).decode(source, 0)
+        with self.assertRaises(struct.error):
+            R.FloatArray('single', 3)(source[:7])
 
 class MetaRecordBasicTests(unittest.TestCase):
     def testSeveralRecords(self):
@@ -228,6 +293,46 @@ class MetaRecordBasicTests(unittest.TestCase):
         self.assertEqual(interpretation['two'].value, 600)
         self.assertEqual(interpretation['three'].value, 70000)
 
+class DecodeTests(unittest.TestCase):
+    def testFloatDecodeMatchesCall(self):
+        for Type, length in [('single', 4), ('double', 8)]:
+            record = R.Float(Type)
+            source = bytes(random.randrange(0, 256) for x in range(length * 500))
+            for i in range(0, len(source), length):
+                self.assertEqual(record.decode(source, i),
+                                 (record(source[i:])[0], i + length))
+
+    def testDecodeMatchesCall(self):
+        source = memoryview(bytes(range(1, 12)) + b'12345abc' + b'\xff' * 6)
+        records = [R.Integer(1), R.Integer(2, signed=True), R.Integer(3),
+                   R.Integer(5, signed=True), R.AsciiInteger(5),
+                   R.FixedLengthString(3), R.PlainBytes(4), R.PlainBytes()]
+        offset = 0
+        for record in records:
+            value, rest = record(source[offset:])
+            self.assertEqual(record.decode(source, offset),
+                             (value, len(source) - len(rest)))
+            offset = len(source) - len(rest)
+
+    def testRecordFunctionsWithoutDecode(self):
+        def two_digits(source, **kwargs):
+            return int(bytes(source[:2])), source[2:]
+        source = memoryview(b'\x07' + b'42' + b'\x09')
+        record = R.Series(
+                    one=R.Integer(1),
+                    two=two_digits,
+                    three=R.Decoder(
+                        lambda buffer, offset, **kwargs:
+                            (buffer[offset] * 2, offset + 1)),
+                )
+        tree, rest, end = process_meta_record(source, record)
+        self.assertEqual(tree['two']._debug_info, {'start' : 1, 'end' : 2})
+        self.assertEqual(tree['three']._debug_info, {'start' : 3, 'end' : 3})
+        self.assertEqual(tree_to_values(tree),
+                         {'one' : 7, 'two' : 42, 'three' : 18})
+        self.assertEqual((len(rest), end), (0, 4))
+        self.assertEqual(record(source)[0]['three'].value, 18)
+
 class IfTests(unittest.TestCase):
     def testDifferentInterpretations(self):
         number = b'4321'
@@ -331,6 +436,1266 @@ class SeriesTests(unittest.TestCase):
         interpretation = tree_to_values(process_meta_record(source, record)[0])
         self.assertEqual(expected_interpretation, interpretation)
 
+    def testNestedOrderAndOffsets(self):
+        source = memoryview(b'12' + b'345' + b'6' + b'78' + b'9')
+        record = R.Series(
+                    a=R.AsciiInteger(2),
+                    b=R.List([R.AsciiInteger(3),
+                              R.Series(c=R.AsciiInteger(1),
+                                       d=R.AsciiInteger(2))]),
+                    e=R.AsciiInteger(1),
+                )
+        tree = process_meta_record(source, record, compile_fixed=False)[0]
+        leaves = [tree['a'], tree['b'][0], tree['b'][1]['c'],
+                  tree['b'][1]['d'], tree['e']]
+        self.assertEqual([(leaf._debug_info['start'], leaf._debug_info['end'])
+                          for leaf in leaves],
+                         [(0, 1), (2, 4), (5, 5), (6, 7), (8, 8)])
+        self.assertEqual(tree_to_values(tree),
+                         {'a' : 12, 'b' : [345, {'c' : 6, 'd' : 78}], 'e' : 9})
+
+    def testWideList(self):
+        count = 100000
+        source = memoryview(b''.join(int_to_bytes(i, 4) for i in range(count)))
+        record = R.List(count * [R.Integer(4)])
+        tree, rest, end = process_meta_record(source, record,
+                                              compile_fixed=False)
+        self.assertEqual(tree[count - 1]._debug_info,
+                         {'start' : 4 * (count - 1), 'end' : 4 * count - 1})
+        self.assertEqual(tree_to_values(tree), list(range(count)))
+        self.assertEqual((len(rest), end), (0, 4 * count))
+
+class ValuesOnlyTests(unittest.TestCase):
+    def setUp(self):
+        self.source = memoryview(b'01234' + int_to_bytes(4090, 2) +
+                                 b'foolish' + b'\x80\x40\x00\x00' * 3)
+        self.record = R.Series(
+                    num=R.AsciiInteger(5),
+                    rest=R.Series(
+                        plain_bytes=R.If(
+                            lambda root, current: current.p['num'],
+                            lambda value:
+                                R.PlainBytes(2) if value == 1234 else
+                                R.Integer(2)),
+                        string=R.FixedLengthString(7)),
+                    floats=R.List(3*[R.Float('single')]),
+                )
+
+    def testSameValues(self):
+        for compile_fixed in (True, False):
+            tree, rest, end = process_meta_record(
+                    self.source, self.record, start=10,
+                    compile_fixed=compile_fixed)
+            values, values_rest, values_end = process_meta_record(
+                    self.source, self.record, start=10,
+                    compile_fixed=compile_fixed, values_only=True)
+            self.assertEqual(values, tree_to_values(tree))
+            self.assertEqual((bytes(values_rest), values_end),
+                             (bytes(rest), end))
+
+    def testNodeDebugInfo(self):
+        tree = process_meta_record(self.source, self.record, start=10)[0]
+        self.assertEqual(tree['rest']['string']._debug_info,
+                         {'start' : 17, 'end' : 23})
+        self.assertFalse(hasattr(tree, '__dict__'))
+
+class CompileDecoderTests(unittest.TestCase):
+    def assertSameValues(self, source, record):
+        expected, rest, _ = process_meta_record(
+                source, record, values_only=True)
+        values, offset = compile_decoder(record)(source)
+        self.assertEqual(values, expected)
+        self.assertEqual(offset, len(source) - len(rest))
+
+    def testSeries(self):
+        source = memoryview(b'01234' + int_to_bytes(4090, 2) + b'foolish')
+        self.assertSameValues(source, R.Series(
+                    num=R.AsciiInteger(5),
+                    rest=R.Series(
+                        plain_bytes=R.If(
+                            lambda root, current: root['num'],
+                            lambda value:
+                                R.PlainBytes(2) if value == 1234 else
+                                R.Integer(2)),
+                        string=R.FixedLengthString(7))))
+        source = memoryview(b'12' + b'345' + b'6' + b'78' + b'9')
+        self.assertSameValues(source, R.Series(
+                    a=R.AsciiInteger(2),
+                    b=R.List([R.AsciiInteger(3),
+                              R.Series(c=R.AsciiInteger(1),
+                                       d=R.AsciiInteger(2))]),
+                    e=R.AsciiInteger(1)))
+
+    def testOtherErrorsRaised(self):
+        # Not something the bytes could cause, so it isn't interpreted
+        # again by process_meta_record.
+        calls = []
+        def broken(source, **kwargs):
+            calls.append(source)
+            raise RuntimeError('broken')
+        decode = compile_decoder(R.Series(a=R.Integer(1), b=broken))
+        with self.assertRaises(RuntimeError):
+            decode(memoryview(b'\x01\x02'))
+        self.assertEqual(len(calls), 1)
+
+    def testRecordFunctions(self):
+        def two_digits(source, **kwargs):
+            return int(bytes(source[:2])), source[2:]
+        source = memoryview(b'\x07' + b'42' + b'\x09' + b'rest')
+        self.assertSameValues(source, R.Series(
+                    one=R.Integer(1),
+                    two=two_digits,
+                    three=R.Decoder(
+                        lambda buffer, offset, **kwargs:
+                            (buffer[offset] * 2, offset + 1)),
+                    four=R.PlainBytes()))
+
+    def testIfBranches(self):
+        record = R.Series(
+                    kind=R.Integer(1),
+                    value=R.If(
+                        lambda root, current: current['kind'],
+                        lambda value:
+                            R.AsciiInteger(4) if value == 0 else
+                            R.FixedLengthString(4) if value == 1 else
+                            R.List(2*[R.Integer(2)])))
+        for kind in range(3):
+            self.assertSameValues(memoryview(bytes([kind]) + b'4321'), record)
+
+    def testLogicalRecords(self):
+        source = memoryview(sample_file_15())
+        for start, end in f_bidr.logical_record_spans(source):
+            self.assertSameValues(source[start:end], f_bidr.logical_record)
+
+    def testShortSource(self):
+        # The generated code can't unpack it, so the values are those
+        # of process_meta_record.
+        record = R.Series(a=R.Integer(2), b=R.Integer(4))
+        self.assertSameValues(memoryview(b'\x01\x02\x03'), record)
+
+class FixedLayoutTests(unittest.TestCase):
+    record = R.Series(
+        header=R.Series(
+            count=R.Integer(2),
+            signed=R.Integer(3, signed=True),
+            name=R.FixedLengthString(4),
+            ascii=R.AsciiInteger(3),
+        ),
+        floats=R.List([R.Float('single'), R.Float('double')]),
+        array=R.FloatArray('single', 2),
+        blanks=R.PlainBytes(2),
+    )
+    source = b''.join([
+        int_to_bytes(513, 2),
+        int_to_bytes(-70000, 3, signed=True),
+        b'abcd',
+        b'042',
+        bytes.fromhex('4941d00f 9ec052066214e7ce'),
+        bytes.fromhex('80400000 60c10000'),
+        b'\x00\x01',
+        b'rest',
+    ])
+
+    def testCompiles(self):
+        self.assertIsNotNone(FixedLayout.compile(self.record))
+        self.assertIsNone(FixedLayout.compile(R.Series(
+                one=R.Integer(1), rest=R.PlainBytes())))
+        self.assertIsNone(FixedLayout.compile(R.Series(
+                one=R.Integer(1),
+                two=R.If(lambda root, _: root['one'], lambda v: R.Integer(v)))))
+
+    def testSameAsUncompiled(self):
+        wrapped = R.Series(block=self.record)
+        compiled, rest, end = process_meta_record(self.source, wrapped,
+                                                  compile_fixed=True)
+        walked, walked_rest, walked_end = process_meta_record(
+                self.source, wrapped, compile_fixed=False)
+        self.assertEqual(bytes(rest), b'rest')
+        self.assertEqual(end, walked_end)
+        compiled = tree_to_values(compiled)
+        walked = tree_to_values(walked)
+        self.assertEqual(compiled['block']['array'].tolist(),
+                walked['block']['array'].tolist())
+        del compiled['block']['array'], walked['block']['array']
+        self.assertEqual(compiled, walked)
+
+    def testIfRefersToCompiled(self):
+        record = R.Series(
+            header=R.Series(length=R.Integer(1), other=R.Integer(1)),
+            body=R.If(
+                lambda root, _: root['header']['length'],
+                lambda value: R.FixedLengthString(value)))
+        tree = process_meta_record(b'\x03\x00abcdef', record,
+                                   compile_fixed=True)[0]
+        self.assertEqual(tree['header']['length'].value, 3)
+        self.assertEqual(tree_to_values(tree)['body'], 'abc')
+
+    def testSameChildNode(self):
+        wrapped = R.Series(block=self.record)
+        tree = process_meta_record(self.source, wrapped, compile_fixed=True)[0]
+        header = tree['block']['header']
+        self.assertIs(header, tree['block']['header'])
+        self.assertIs(header['count'], tree['block']['header']['count'])
+        self.assertIs(header.p, tree['block'])
+
+    def testTreeDebugInfo(self):
+        # Trees aren't compiled unless asked, so every record has
+        # its offsets.
+        tree = process_meta_record(self.source, R.Series(block=self.record))[0]
+        self.assertEqual(tree['block']['header']['name']._debug_info,
+                         {'start' : 5, 'end' : 8})
+        self.assertEqual(tree['block']['blanks']._debug_info,
+                         {'start' : 32, 'end' : 33})
+
+    def testBadBytesReported(self):
+        # Not ascii, so the layout can't interpret it, and neither can
+        # the record, which says where.
+        source = self.source[:5] + b'\xff' + self.source[6:]
+        with self.assertRaises(UnicodeDecodeError):
+            process_meta_record(source, R.Series(block=self.record),
+                                compile_fixed=True)
+
+# Builds F-BIDR logical records for the file reading tests.
+def logical_record_bytes(data_class, label, data, orbit_number=376):
+    body = b''.join([
+        int_to_bytes(data_class, 2),
+        int_to_bytes(4 + len(label), 2),
+        int_to_bytes(orbit_number, 2),
+        bytes([data_class, len(label)]),
+        label,
+        data,
+    ])
+    return b'NJPL1I000104' + b'%08d' % len(body) + body
+
+def image_record_bytes(ref_lines, ref_pixels, line_count, line_length=16,
+                       ranges=None):
+    """ranges is the (offset_to_first, pointer_to_last) of each line.
+    By default they vary a little from line to line."""
+    pixels = line_length - 4
+    if ranges is None:
+        ranges = [(i % 3, pixels - i % 2) for i in range(line_count)]
+    label = b''.join([
+        int_to_bytes(line_count, 2),
+        int_to_bytes(line_length, 2),
+        bytes.fromhex('80400000 60c10000 4941d00f 9e405206'),
+        int_to_bytes(ref_lines, 4, signed=True),
+        int_to_bytes(ref_pixels, 4, signed=True),
+        int_to_bytes(abs(ref_lines) * 7, 4),
+        b'ID = M0257.22-10'.ljust(32),
+    ])
+    data = b''.join(
+            int_to_bytes(ranges[i][0], 2) + int_to_bytes(ranges[i][1], 2) +
+            bytes((ref_lines + i + j) % 256 for j in range(pixels))
+            for i in range(line_count))
+    return logical_record_bytes(2, label, data)
+
+def sample_file_15(records=6):
+    per_orbit = logical_record_bytes(1, b'', bytes(512))
+    return per_orbit + b''.join(
+            image_record_bytes(100 - 10 * i, 3 * i, 5 + i % 3)
+            for i in range(records))
+
+class ReadLogicalRecordsTests(unittest.TestCase):
+    def testFromPath(self):
+        source = sample_file_15()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'FILE_15')
+            with open(path, 'wb') as f:
+                f.write(source)
+            self.assertEqual(f_bidr.read_logical_records(path),
+                             f_bidr.read_logical_records(source))
+            self.assertEqual(f_bidr.read_logical_records(path, 3),
+                             f_bidr.read_logical_records(source)[:3])
+
+    def testParallel(self):
+        source = sample_file_15(12)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'FILE_15')
+            with open(path, 'wb') as f:
+                f.write(source)
+            self.assertEqual(
+                    f_bidr.read_logical_records_parallel(path, 2),
+                    f_bidr.read_logical_records(source))
+
+    def testErrorInDecoder(self):
+        # More lines than the record holds. The error from the image
+        # data block's Decoder is what comes out, in both modes.
+        source = bytearray(image_record_bytes(0, 0, 3))
+        source[28:30] = int_to_bytes(10, 2)
+        with self.assertRaises(struct.error):
+            f_bidr.read_logical_records(bytes(source))
+        with self.assertRaises(struct.error):
+            process_meta_record(memoryview(bytes(source)), f_bidr.logical_record)
+
+    def testParallelFallsBack(self):
+        source = sample_file_15(12)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'FILE_15')
+            with open(path, 'wb') as f:
+                f.write(source)
+            pool = f_bidr.concurrent.futures.ProcessPoolExecutor
+            def no_pool(*args):
+                raise AssertionError('A pool was started.')
+            f_bidr.concurrent.futures.ProcessPoolExecutor = no_pool
+            try:
+                # The pool is only used when asked for.
+                for workers in [None, 1]:
+                    self.assertEqual(f_bidr.read_logical_records_parallel(
+                            path, workers),
+                            f_bidr.read_logical_records(source))
+            finally:
+                f_bidr.concurrent.futures.ProcessPoolExecutor = pool
+
+    def testIterSlices(self):
+        source = sample_file_15()
+        records = f_bidr.read_logical_records(source)
+        self.assertEqual(list(f_bidr.iter_logical_records(source)), records)
+        self.assertEqual(list(f_bidr.iter_logical_records(source, 2, 5)),
+                         records[2:5])
+        self.assertEqual(list(f_bidr.iter_logical_records(source, 5)),
+                         records[5:])
+
+class RecordIndexTests(unittest.TestCase):
+    def testIndex(self):
+        source = sample_file_15()
+        index = f_bidr.build_record_index(source)
+        records = f_bidr.read_logical_records(source)
+        self.assertEqual(len(index), len(records))
+        self.assertEqual(index['data_class'].tolist(),
+                         [r['type'] for r in records])
+        self.assertEqual(int(index['offset'][-1] + index['length'][-1]),
+                         len(source))
+        for name in ['line_count', 'reference_lat', 'reference_offset_lines']:
+            self.assertEqual(index[name][1:].tolist(),
+                             [r[name] for r in records[1:]])
+        self.assertEqual(list(f_bidr.iter_logical_records(
+                            source, 3, 5, index=index)), records[3:5])
+
+    def testCachedBesideFile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'FILE_15')
+            with open(path, 'wb') as f:
+                f.write(sample_file_15(4))
+            index = f_bidr.load_record_index(path)
+            self.assertTrue(os.path.exists(f_bidr.record_index_path(path)))
+            self.assertEqual(f_bidr.load_record_index(path)['offset'].tolist(),
+                             index['offset'].tolist())
+
+            # A changed file gets a new index.
+            with open(path, 'wb') as f:
+                f.write(sample_file_15(6))
+            self.assertEqual(len(f_bidr.load_record_index(path)), 7)
+
+    def testUnwritableDirectory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'FILE_15')
+            with open(path, 'wb') as f:
+                f.write(sample_file_15(4))
+            atomic_write = f_bidr.atomic_write
+            def unwritable(path):
+                raise PermissionError(13, 'Permission denied', path)
+            f_bidr.atomic_write = unwritable
+            try:
+                self.assertEqual(len(f_bidr.load_record_index(path)), 5)
+            finally:
+                f_bidr.atomic_write = atomic_write
+            self.assertFalse(os.path.exists(f_bidr.record_index_path(path)))
+
+    def testAtomicWrite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'file')
+            with f_bidr.atomic_write(path) as f:
+                f.write(b'first')
+                self.assertFalse(os.path.exists(path))
+            with self.assertRaises(KeyError):
+                with f_bidr.atomic_write(path) as f:
+                    f.write(b'second')
+                    raise KeyError()
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'first')
+            self.assertEqual(os.listdir(directory), ['file'])
+
+class LogicalRecordFileTests(unittest.TestCase):
+    def testSequence(self):
+        source = sample_file_15()
+        records = f_bidr.read_logical_records(source)
+        lazy = f_bidr.LogicalRecordFile(source, cache_size=2)
+        self.assertEqual(len(lazy), len(records))
+        self.assertEqual(lazy[3], records[3])
+        self.assertEqual(lazy[-1], records[-1])
+        self.assertEqual(lazy[1:6:2], records[1:6:2])
+        self.assertEqual(list(lazy), records)
+        with self.assertRaises(IndexError):
+            lazy[len(records)]
+
+    def testCacheBounded(self):
+        lazy = f_bidr.LogicalRecordFile(sample_file_15(), cache_size=2)
+        first = lazy[0]
+        self.assertIs(lazy[0], first)
+        lazy[1], lazy[2]
+        self.assertEqual(len(lazy._cache), 2)
+        self.assertIsNot(lazy[0], first)
+
+class SpatialIndexTests(unittest.TestCase):
+    def randomRecords(self, count):
+        records = np.zeros(count, dtype=f_bidr_data.spatial_record_dtype)
+        records['orbit'] = [random.randrange(376, 400) for i in range(count)]
+        records['offset'] = range(count)
+        records['reference_lat'] = [random.uniform(-90, 90) for i in range(count)]
+        records['reference_lon'] = [random.uniform(0, 360) for i in range(count)]
+        return records
+
+    def expected(self, records, lat_min, lat_max, inside_lon):
+        return sorted(r['offset'] for r in records
+                      if lat_min <= r['reference_lat'] <= lat_max
+                      and inside_lon(r['reference_lon']))
+
+    def testQuery(self):
+        records = self.randomRecords(5000)
+        index = f_bidr_data.SpatialIndex(records, cell_size=2.5)
+        found = index.query(-10.3, 20.1, 100.7, 130.2)
+        self.assertEqual(sorted(found['offset'].tolist()),
+                self.expected(records, -10.3, 20.1, lambda lon: 100.7 <= lon <= 130.2))
+
+    def testQueryWraps(self):
+        records = self.randomRecords(5000)
+        index = f_bidr_data.SpatialIndex(records)
+        found = index.query(-90, 90, 350, 10)
+        self.assertEqual(sorted(found['offset'].tolist()),
+                self.expected(records, -90, 90, lambda lon: lon >= 350 or lon <= 10))
+
+    def testQueryFullRange(self):
+        records = self.randomRecords(5000)
+        index = f_bidr_data.SpatialIndex(records)
+        for lon_min, lon_max in [(0, 360), (-180, 180), (-400, 10)]:
+            found = index.query(-90, 90, lon_min, lon_max)
+            self.assertEqual(sorted(found['offset'].tolist()),
+                             list(range(5000)))
+
+    def testQueryAntimeridian(self):
+        records = self.randomRecords(5000)
+        # Some records west of 0, which is the same as east of 180.
+        records['reference_lon'][::2] -= 360
+        index = f_bidr_data.SpatialIndex(records, cell_size=3)
+        expected = self.expected(records, -30, 40,
+                                 lambda lon: 170 <= lon % 360 <= 190)
+        for lon_min, lon_max in [(170, -170), (170, 190), (-190, -170)]:
+            found = index.query(-30, 40, lon_min, lon_max)
+            self.assertEqual(sorted(found['offset'].tolist()), expected)
+        expected = self.expected(records, -30, 40,
+                                 lambda lon: not 10 < lon % 360 < 350)
+        for lon_min, lon_max in [(350, 10), (-10, 10), (350, 370)]:
+            found = index.query(-30, 40, lon_min, lon_max)
+            self.assertEqual(sorted(found['offset'].tolist()), expected)
+
+    def testSaveLoad(self):
+        records = self.randomRecords(100)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spatial-index.npz')
+            f_bidr_data.SpatialIndex(records, cell_size=2).save(path)
+            # A save that fails partway leaves the saved index alone.
+            class Unsaveable:
+                def __array__(self, *args, **kwargs):
+                    raise ValueError('Not an array.')
+            broken = f_bidr_data.SpatialIndex(records, cell_size=2)
+            broken.records = Unsaveable()
+            with self.assertRaises(ValueError):
+                broken.save(path)
+            self.assertEqual(os.listdir(directory), ['spatial-index.npz'])
+            index = f_bidr_data.SpatialIndex.load(path)
+            self.assertEqual(index.cell_size, 2)
+            self.assertEqual(sorted(index.records['offset'].tolist()),
+                             sorted(records['offset'].tolist()))
+
+    def testBuildFromLocalFiles(self):
+        temporary_orbit_cache(self)
+        data_root = f_bidr_data.data_root
+        with tempfile.TemporaryDirectory() as directory:
+            f_bidr_data.data_root = directory
+            try:
+                path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+                os.makedirs(os.path.dirname(path))
+                source = sample_file_15()
+                with open(path, 'wb') as f:
+                    f.write(source)
+                f_bidr_data.build_spatial_index()
+                index = f_bidr_data.load_spatial_index()
+                self.assertEqual(len(index), 6)
+                found = list(f_bidr_data.read_region_records(index, 3, 4, 1, 2))
+                self.assertEqual([record for _, _, record in found],
+                                 f_bidr.read_logical_records(source)[1:])
+                self.assertEqual(len(index.query(-3, 3, 1, 2)), 0)
+            finally:
+                f_bidr_data.data_root = data_root
+
+def temporary_orbit_cache(test):
+    """Gives f_bidr_data.orbits a cache in a temporary directory until
+    test is done, so that tests don't write into the project's
+    __pycache__."""
+    directory = tempfile.TemporaryDirectory()
+    orbits = f_bidr_data.orbits
+    f_bidr_data.orbits = f_bidr_data.OrbitCatalog(
+            orbits.path, os.path.join(directory.name, 'record-order.pickle'))
+    def restore():
+        f_bidr_data.orbits = orbits
+        directory.cleanup()
+    test.addCleanup(restore)
+
+class OrbitCatalogTests(unittest.TestCase):
+    def testLazyAndCached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'record-order')
+            cache_path = os.path.join(directory, 'cache', 'record-order.pickle')
+            with open(path, 'w') as f:
+                f.write('MG_4566/F0376_01\nMG_4001/F0376_3\nMG_4566/F0377_01\n')
+            catalog = f_bidr_data.OrbitCatalog(path, cache_path)
+            self.assertFalse(os.path.exists(cache_path))
+            self.assertEqual(dict(catalog), {
+                376 : ['MG_4566/F0376_01', 'MG_4001/F0376_3'],
+                377 : ['MG_4566/F0377_01']})
+            self.assertTrue(os.path.exists(cache_path))
+
+            # The cache is used while record-order is unchanged...
+            with open(cache_path, 'rb') as f:
+                key, orbits = pickle.load(f)
+            with open(cache_path, 'wb') as f:
+                pickle.dump((key, {1 : ['cached']}), f)
+            self.assertEqual(dict(f_bidr_data.OrbitCatalog(path, cache_path)),
+                             {1 : ['cached']})
+
+            # ...and dropped once it changes.
+            with open(path, 'a') as f:
+                f.write('MG_4566/F0378_01\n')
+            self.assertEqual(sorted(f_bidr_data.OrbitCatalog(path, cache_path)),
+                             [376, 377, 378])
+
+    def testRecordOrder(self):
+        temporary_orbit_cache(self)
+        self.assertEqual(f_bidr_data.orbits[376][2], 'MG_4001/F0376_3')
+
+# Stands in for the PDS mirror. Serves files from a dict of paths to
+# bytes, with keep-alive connections and Range requests, and redirects
+# from a dict of paths to locations.
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    redirects = {}
+    ranges = []
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        MirrorHandler.connections += 1
+
+    def do_GET(self):
+        if self.path in self.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.redirects[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path not in self.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.files[self.path]
+        requested = self.headers.get('Range')
+        MirrorHandler.ranges.append(requested)
+        if requested is None:
+            self.send_response(200)
+        else:
+            start = int(requested[len('bytes='):-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                    f'bytes {start}-{len(body) - 1}/{len(body)}')
+            body = body[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MirrorTestCase(unittest.TestCase):
+    def setUp(self):
+        MirrorHandler.files = {}
+        MirrorHandler.redirects = {}
+        MirrorHandler.ranges = []
+        MirrorHandler.connections = 0
+        temporary_orbit_cache(self)
+        self.server = http.server.ThreadingHTTPServer(
+                ('127.0.0.1', 0), MirrorHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.f_bidr_root = f_bidr_data.f_bidr_root
+        self.data_root = f_bidr_data.data_root
+        f_bidr_data.f_bidr_root = f'http://127.0.0.1:{self.server.server_port}/'
+        f_bidr_data.data_root = self.directory.name
+        f_bidr_data.close_connections()
+
+    def tearDown(self):
+        f_bidr_data.close_connections()
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+        f_bidr_data.f_bidr_root = self.f_bidr_root
+        f_bidr_data.data_root = self.data_root
+
+    def serve(self, number, version, filename, contents):
+        MirrorHandler.files[self.path(number, version, filename)] = contents
+
+    def path(self, number, version, filename):
+        return f'/{f_bidr_data.orbits[number][version - 1]}/{filename.upper()}'
+
+class DownloadTests(MirrorTestCase):
+    def testDownloadReusesConnection(self):
+        self.serve(376, 1, 'file_15', b'first' * 1000)
+        self.serve(376, 2, 'file_15', b'second' * 1000)
+        for version, contents in [(1, b'first'), (2, b'second')]:
+            path = f_bidr_data.get_orbit_file_path(376, 'file_15', version)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), contents * 1000)
+        self.assertEqual(MirrorHandler.connections, 1)
+
+    def testResume(self):
+        contents = bytes(range(256)) * 100
+        self.serve(376, 1, 'file_15', contents)
+        path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+        os.makedirs(os.path.dirname(path))
+        with open(path + '.part', 'wb') as f:
+            f.write(contents[:1000])
+        f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        self.assertEqual(MirrorHandler.ranges, ['bytes=1000-'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+    def testMissing(self):
+        with self.assertRaises(ValueError):
+            f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+        self.assertFalse(os.path.exists(path))
+
+    def testRedirect(self):
+        self.serve(376, 2, 'file_15', b'moved' * 1000)
+        # One relative, and one to another host name for the server,
+        # which needs a connection of its own.
+        MirrorHandler.redirects = {
+            self.path(376, 1, 'file_15') : self.path(376, 3, 'file_15'),
+            self.path(376, 3, 'file_15') :
+                f'http://localhost:{self.server.server_port}'
+                + self.path(376, 2, 'file_15'),
+        }
+        path = f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'moved' * 1000)
+
+    def testRedirectLoop(self):
+        MirrorHandler.redirects = {
+            self.path(376, 1, 'file_15') : self.path(376, 2, 'file_15'),
+            self.path(376, 2, 'file_15') : self.path(376, 1, 'file_15'),
+        }
+        with self.assertRaises(urllib.error.HTTPError):
+            f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+
+    def testCloseConnections(self):
+        self.serve(376, 1, 'file_15', b'first' * 1000)
+        self.serve(376, 2, 'file_15', b'second' * 1000)
+        f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        f_bidr_data.close_connections()
+        # A new connection is made after they're closed.
+        f_bidr_data.get_orbit_file_path(376, 'file_15', 2)
+        self.assertEqual(MirrorHandler.connections, 2)
+
+    def testDownloadAll(self):
+        numbers = [376, 377, 378]
+        for number in numbers:
+            for version in range(1, len(f_bidr_data.orbits[number]) + 1):
+                self.serve(number, version, 'file_15', b'%d' % number * version)
+        f_bidr_data.download_all_orbit_files('file_15', numbers, workers=3)
+        for number in numbers:
+            for version in range(1, len(f_bidr_data.orbits[number]) + 1):
+                with open(f_bidr_data.gen_local_path(number, version, 'file_15'), 'rb') as f:
+                    self.assertEqual(f.read(), b'%d' % number * version)
+
+class LocalCatalogTests(MirrorTestCase):
+    def testRecordsDownloads(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        path = f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        entry = f_bidr_data.local_catalog().get(376, 1, 'file_15')
+        self.assertEqual(entry['size'], len(contents))
+        self.assertEqual(entry['sha256'], hashlib.sha256(contents).hexdigest())
+        self.assertEqual((entry['records'], entry['image_records']), (7, 6))
+        self.assertEqual(f_bidr_data.get_orbit_file_paths([376], 'file_15', 1),
+                         [path])
+
+    def testRefetchesTruncated(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        path = f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        with open(path, 'r+b') as f:
+            f.truncate(len(contents) - 10)
+        f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+    def testFilesFromBeforeCatalog(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        for version, written in [(1, contents[:-10]), (2, contents)]:
+            path = f_bidr_data.gen_local_path(376, version, 'file_15')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(written)
+
+        # Version 2 isn't on the mirror, so it must not be downloaded.
+        f_bidr_data.get_orbit_file_path(376, 'file_15', 2)
+        path = f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(len(f_bidr_data.local_catalog().entries()), 2)
+
+    def testFilesCutInHeaders(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        third = int(f_bidr.build_record_index(contents)['offset'][2])
+        path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+        os.makedirs(os.path.dirname(path))
+        # In the first primary header, in the NJPL part and the length
+        # of a later one, and in the label of an image record.
+        for cut in [5, third + 5, third + 15, third + 50]:
+            with open(path, 'wb') as f:
+                f.write(contents[:cut])
+            self.assertFalse(f_bidr_data.file_is_complete(path))
+            f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), contents)
+            f_bidr_data.local_catalog().remove(376, 1, 'FILE_15')
+
+    def testVerify(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        path = f_bidr_data.get_orbit_file_path(376, 'file_15', 1)
+        self.assertEqual(f_bidr_data.verify_orbit_files(full=True), [])
+        with open(path, 'r+b') as f:
+            f.write(b'X')
+        self.assertEqual(f_bidr_data.verify_orbit_files(), [])
+        self.assertEqual(f_bidr_data.verify_orbit_files(full=True),
+                         [(376, 1, 'FILE_15')])
+
+class StreamTests(MirrorTestCase):
+    def testStream(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        records = list(f_bidr_data.stream_orbit_records(376, 'file_15', 1))
+        self.assertEqual(records, f_bidr.read_logical_records(contents))
+        path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertIsNotNone(f_bidr_data.local_catalog().get(376, 1, 'file_15'))
+
+        # Now it's read from disk, not the mirror.
+        self.assertEqual(
+                list(f_bidr_data.stream_orbit_records(376, 'file_15', 1)),
+                records)
+        self.assertEqual(MirrorHandler.ranges, [None])
+
+    def testFileFromBeforeCatalog(self):
+        contents = sample_file_15()
+        path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(contents)
+        # Not on the mirror, so it has to come from the file.
+        records = list(f_bidr_data.stream_orbit_records(376, 'file_15', 1))
+        self.assertEqual(records, f_bidr.read_logical_records(contents))
+        self.assertEqual(MirrorHandler.ranges, [])
+        self.assertIsNotNone(f_bidr_data.local_catalog().get(376, 1, 'file_15'))
+
+    def testStopEarly(self):
+        contents = sample_file_15()
+        self.serve(376, 1, 'file_15', contents)
+        stream = f_bidr_data.stream_orbit_records(376, 'file_15', 1)
+        first = next(stream)
+        stream.close()
+        path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+        self.assertFalse(os.path.exists(path))
+        have = os.path.getsize(path + '.part')
+        self.assertLess(have, len(contents))
+
+        records = list(f_bidr_data.stream_orbit_records(376, 'file_15', 1))
+        self.assertEqual(records, f_bidr.read_logical_records(contents))
+        self.assertEqual(records[0], first)
+        self.assertEqual(MirrorHandler.ranges, [None, f'bytes={have}-'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+    def testCutShort(self):
+        contents = sample_file_15()
+        with self.assertRaises(ValueError):
+            list(f_bidr.iter_logical_records_from_stream(
+                    io.BytesIO(contents[:-10])))
+
+class RecordColumnsTests(unittest.TestCase):
+    def processing_record(self, burst_counter):
+        data = bytearray(random.randrange(0, 256) for x in range(1272))
+        data[0:4] = int_to_bytes(burst_counter, 4)
+        return logical_record_bytes(4, bytes(7), bytes(data))
+
+    def testProcessing(self):
+        source = b''.join([
+            self.processing_record(5),
+            image_record_bytes(0, 0, 3),
+            self.processing_record(6),
+            self.processing_record(7),
+        ])
+        records = [r for r in f_bidr.read_logical_records(source)
+                   if r['type'] == 4]
+        columns = f_bidr.read_record_columns(source, 4)
+        self.assertEqual(columns['data.burst_counter'].tolist(), [5, 6, 7])
+        self.assertEqual(columns['data.craft_pos_j2000'].shape, (3, 3))
+        for name in ['burst_reference_time', 'echo_delay_time',
+                     'craft_pos_j2000', 'look_angle']:
+            expected = [r['data'][name] for r in records]
+            self.assertEqual(columns['data.' + name].tolist(), expected)
+        self.assertEqual(columns['orbit_number'].tolist(), [376] * 3)
+
+    def testProcessingAndMonitor(self):
+        # Oblique sinusoidal processing parameters are laid out as the
+        # sinusoidal ones are. Monitor records are something else, so
+        # their data block is left as bytes.
+        oblique = bytearray(self.processing_record(9))
+        oblique[26] = 68
+        monitor = logical_record_bytes(16, bytes(7), b'monitor data')
+        records = f_bidr.read_logical_records(bytes(oblique) + monitor)
+        self.assertEqual(records[0]['data']['burst_counter'], 9)
+        self.assertEqual(records[1]['type'], 16)
+        self.assertEqual(records[1]['data'], b'monitor data')
+
+    def testImageLabels(self):
+        source = sample_file_15()
+        records = [r for r in f_bidr.read_logical_records(source)
+                   if r['type'] in f_bidr.image_data_classes]
+        columns = f_bidr.read_record_columns(source, f_bidr.image_data_classes)
+        for name in ['line_count', 'reference_lat', 'reference_offset_lines',
+                     'burst_counter', 'nav_unique_id']:
+            self.assertEqual(columns[name].tolist(),
+                             [r[name] for r in records])
+        self.assertNotIn('data.line', columns)
+
+    def testDifferentSchemas(self):
+        with self.assertRaises(ValueError):
+            f_bidr.read_record_columns(sample_file_15(), [1, 2])
+
+class ColumnStoreTests(unittest.TestCase):
+    def testReadColumns(self):
+        sources = {376 : sample_file_15(), 377 : sample_file_15(4)}
+        with tempfile.TemporaryDirectory() as directory:
+            store = f_bidr_data.ColumnStore(directory)
+            for number, source in sources.items():
+                store.write(number, 1, source)
+            self.assertEqual(store.row_groups('image-labels'),
+                             [(376, 1), (377, 1)])
+            self.assertIn('data.orbit_number', store.columns('per-orbit'))
+
+            columns = store.read('image-labels', ['reference_lat', 'line_count'])
+            self.assertEqual(set(columns),
+                             {'reference_lat', 'line_count', 'version'})
+            expected = [f_bidr.read_record_columns(
+                            source, f_bidr.image_data_classes)
+                        for source in sources.values()]
+            self.assertEqual(columns['line_count'].tolist(),
+                             [n for e in expected for n in e['line_count']])
+
+            columns = store.read('image-labels', numbers=[377])
+            self.assertEqual(columns['nav_unique_id'].tolist(),
+                             expected[1]['nav_unique_id'].tolist())
+            self.assertEqual(len(store.read('processing')['offset']), 0)
+
+    def testExport(self):
+        temporary_orbit_cache(self)
+        data_root = f_bidr_data.data_root
+        with tempfile.TemporaryDirectory() as directory:
+            f_bidr_data.data_root = directory
+            try:
+                path = f_bidr_data.gen_local_path(376, 1, 'file_15')
+                os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(sample_file_15())
+                f_bidr_data.export_columns(numbers=[376, 377])
+                columns = f_bidr_data.load_columns('per-orbit', ['orbit_number'])
+                self.assertEqual(columns['orbit_number'].tolist(), [376])
+            finally:
+                f_bidr_data.data_root = data_root
+
+class RecordCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for records in [4, 5, 6]:
+            path = os.path.join(self.directory.name, f'FILE_15-{records}')
+            with open(path, 'wb') as f:
+                f.write(sample_file_15(records))
+            self.paths.append(path)
+        self.cache = f_bidr_data.RecordCache(
+                os.path.join(self.directory.name, 'cache'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testRead(self):
+        path = self.paths[0]
+        self.assertIsNone(self.cache.get(path))
+        records = self.cache.read(path)
+        self.assertEqual(records, f_bidr.read_logical_records(path))
+        self.assertEqual(self.cache.get(path), records)
+        self.assertEqual(self.cache.read(path, 2), records[:2])
+
+        # A changed file is a different entry.
+        with open(path, 'ab') as f:
+            f.write(sample_file_15(1))
+        self.assertIsNone(self.cache.get(path))
+
+    def testSchemaChange(self):
+        path = self.paths[0]
+        self.cache.read(path)
+        fingerprint = f_bidr.logical_record_fingerprint
+        f_bidr.logical_record_fingerprint = lambda: 'changed'
+        try:
+            self.assertIsNone(self.cache.get(path))
+            self.cache.read(path)
+            self.assertEqual(len(os.listdir(self.cache.directory)), 2)
+        finally:
+            f_bidr.logical_record_fingerprint = fingerprint
+
+    def testEvictsLeastRecentlyUsed(self):
+        first, second, third = self.paths
+        sizes = [len(pickle.dumps(f_bidr.read_logical_records(path),
+                                  protocol=pickle.HIGHEST_PROTOCOL))
+                 for path in self.paths]
+        self.cache.max_bytes = sizes[0] + sizes[2]
+        self.cache.read(first)
+        self.cache.read(second)
+        self.cache.get(first)
+        self.cache.read(third)
+        self.assertIsNotNone(self.cache.get(first))
+        self.assertIsNone(self.cache.get(second))
+        self.assertLessEqual(self.cache.size(), self.cache.max_bytes)
+
+    def testFingerprint(self):
+        record = R.Series(a=R.Integer(2), b=R.If(lambda root, current: root['a'],
+                                                  lambda value: R.Integer(2)))
+        same = R.Series(a=R.Integer(2), b=R.If(lambda root, current: root['a'],
+                                                lambda value: R.Integer(2)))
+        self.assertEqual(schema_fingerprint(record), schema_fingerprint(same))
+        for other in [R.Series(a=R.Integer(2, signed=True), b=record.records['b']),
+                      R.Series(a=R.Integer(2), b=R.If(lambda root, current: root['a'],
+                                                      lambda value: R.Integer(4))),
+                      R.Series(b=R.Integer(2), a=record.records['b'])]:
+            self.assertNotEqual(schema_fingerprint(record),
+                                schema_fingerprint(other))
+
+class ImageRecordsTests(unittest.TestCase):
+    def testMatchesLogicalRecords(self):
+        source = sample_file_15()
+        records = f_bidr.read_logical_records(source)[1:]
+        images = f_bidr.read_image_records(source)
+        self.assertEqual(len(images), len(records))
+        for name in ['line_count', 'line_length', 'reference_lat',
+                     'reference_lon', 'proj_origin_lat', 'proj_origin_lon',
+                     'reference_offset_lines', 'reference_offset_pixels',
+                     'burst_counter', 'orbit_number']:
+            self.assertEqual(images.header[name].tolist(),
+                             [r[name] for r in records])
+
+        for i, record in enumerate(records):
+            self.assertEqual(images.lines(i).tolist(),
+                    [list(line['line']) for line in record['data']])
+            self.assertEqual(images.offset_to_first(i).tolist(),
+                    [line['offset_to_first'] for line in record['data']])
+            self.assertEqual(images.pointer_to_last(i).tolist(),
+                    [line['pointer_to_last'] for line in record['data']])
+
+    def testOffsets(self):
+        source = sample_file_15()
+        index = f_bidr.build_record_index(source)
+        images = f_bidr.read_image_records(source, offsets=index['offset'][[2, 4]])
+        everything = f_bidr.read_image_records(source)
+        self.assertEqual(images.header.tolist(), everything.header[[1, 3]].tolist())
+
+    def testViewsShareBuffer(self):
+        source = bytearray(sample_file_15())
+        images = f_bidr.read_image_records(source)
+        first = images.lines(0)
+        source[int(images.header['data_offset'][0]) + 4] = 255
+        self.assertEqual(first[0, 0], 255)
+
+# Records that overlap one another, with records of uneven sizes.
+overlapping_placements = [(40, 0, 6, 12), (38, 3, 7, 16), (36, 20, 4, 10),
+                          (30, 8, 9, 20), (25, -5, 3, 12)]
+
+def image_file_15(placements):
+    """A FILE_15 with an image record of (ref_lines, ref_pixels,
+    line_count, line_length) for each of placements."""
+    per_orbit = logical_record_bytes(1, b'', bytes(512))
+    return per_orbit + b''.join(image_record_bytes(*placement)
+                                for placement in placements)
+
+def write_file(directory, contents, name='FILE_15'):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return path
+
+def block_means(picture, placed, factor):
+    """Means of the placed pixels in each factor by factor block of
+    picture, rounded as ImagePyramid rounds them."""
+    height, width = picture.shape
+    shape = (-(-height // factor) * factor, -(-width // factor) * factor)
+    sums, counts = np.zeros(shape, np.int64), np.zeros(shape, np.int64)
+    sums[:height, :width] = np.where(placed, picture, 0)
+    counts[:height, :width] = placed
+    blocks = (shape[0] // factor, factor, shape[1] // factor, factor)
+    sums = sums.reshape(blocks).sum(axis=(1, 3))
+    counts = counts.reshape(blocks).sum(axis=(1, 3))
+    return ((sums + counts // 2) // np.maximum(counts, 1)).astype(np.uint8)
+
+def masked_stitch(records):
+    """image_stitch of a list of records as it was done before
+    valid_pixels, with a masked array for each line."""
+    left_most = min(r['reference_offset_pixels'] for r in records)
+    right_most = max(r['reference_offset_pixels'] + r['line_length']
+                     for r in records)
+    top_most = max(r['reference_offset_lines'] for r in records)
+    bottom_most = min(r['reference_offset_lines'] - r['line_count']
+                      for r in records)
+    picture = np.zeros((top_most - bottom_most, right_most - left_most),
+                       dtype=np.uint8)
+    for record in records:
+        length = record['line_length'] - 4
+        image = ma.stack([ma.array(np.frombuffer(x['line'], dtype=np.uint8),
+                                   mask=np.array(
+                                       [True] * x['offset_to_first'] +
+                                       [False] * (x['pointer_to_last'] -
+                                                  x['offset_to_first']) +
+                                       [True] * (length - x['pointer_to_last'])))
+                          for x in record['data']], axis=0)
+        top = top_most - record['reference_offset_lines']
+        left = record['reference_offset_pixels'] - left_most
+        region = picture[top:top + image.shape[0], left:left + image.shape[1]]
+        valids = ~ma.getmaskarray(image)
+        region[valids] = image[valids]
+    return picture
+
+class ImageStitchTests(unittest.TestCase):
+    def check(self, source):
+        records = f_bidr.read_logical_records(source)[1:]
+        expected = masked_stitch(records)
+        np.testing.assert_array_equal(images.image_stitch(records, None),
+                                      expected)
+        np.testing.assert_array_equal(
+                images.image_stitch(f_bidr.read_image_records(source), None),
+                expected)
+
+    def testMatchesMasked(self):
+        self.check(sample_file_15())
+
+    def testOverlapping(self):
+        self.check(image_file_15(overlapping_placements))
+
+    def testEmptyRanges(self):
+        # Lines with no valid pixels, at the start, middle and end.
+        ranges = [(0, 12), (0, 0), (5, 5), (12, 12), (2, 9)]
+        source = (logical_record_bytes(1, b'', bytes(512)) +
+                  image_record_bytes(20, 0, 5, 16, ranges) +
+                  image_record_bytes(18, 4, 5, 16, ranges[::-1]))
+        self.check(source)
+
+class ExtractRegionTests(unittest.TestCase):
+    def testMatchesStitch(self):
+        source = image_file_15(overlapping_placements)
+        picture = images.image_stitch(f_bidr.read_logical_records(source)[1:],
+                                      None)
+        left_most, top_most, height, width = images.stitch_bounds(
+                f_bidr.read_image_records(source))
+        # The picture with a border around it, for windows that go past
+        # its edges.
+        border = 50
+        padded = np.pad(picture, border)
+        rng = random.Random(14)
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_file(directory, source)
+            windows = [((top_most - height, top_most + 1),
+                        (left_most, left_most + width)),
+                       # Nothing in these.
+                       ((top_most + 5, top_most + 9), (left_most, left_most + 9)),
+                       ((0, 40), (left_most - 20, left_most - 2))]
+            for _ in range(50):
+                line_low = rng.randrange(top_most - height - 20, top_most + 20)
+                pixel_low = rng.randrange(left_most - 20, left_most + width + 20)
+                windows.append(((line_low, line_low + rng.randrange(0, 25)),
+                                (pixel_low, pixel_low + rng.randrange(0, 25))))
+            for line_range, pixel_range in windows:
+                (line_low, line_high), (pixel_low, pixel_high) = line_range, pixel_range
+                # Row r of picture is line offset top_most - r, and
+                # column c is pixel offset left_most + c.
+                expected = padded[
+                        border + top_most - line_high + 1:
+                            border + top_most - line_low + 1,
+                        border + pixel_low - left_most:
+                            border + pixel_high - left_most]
+                found = images.extract_region_from_file(path, line_range,
+                                                        pixel_range)
+                np.testing.assert_array_equal(found, expected,
+                        err_msg=f'{line_range} {pixel_range}')
+
+class ProcessFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = write_file(self.directory.name, sample_file_15())
+        self.savepath = os.path.join(self.directory.name, 'file.png')
+        self.read_cached_records = images.read_cached_records
+        self.cached = []
+        def read_cached_records(path):
+            self.cached.append(path)
+            return f_bidr.read_logical_records(path)
+        images.read_cached_records = read_cached_records
+
+    def tearDown(self):
+        images.read_cached_records = self.read_cached_records
+        self.directory.cleanup()
+
+    def testUncachedByDefault(self):
+        images.process_file(self.path, self.savepath, 2)
+        self.assertEqual(self.cached, [])
+        self.assertTrue(os.path.exists(
+                os.path.join(self.directory.name, '0-file.png')))
+
+    def testCache(self):
+        images.process_file(self.path, self.savepath, 2, cache=True)
+        self.assertEqual(self.cached, [self.path])
+        self.assertTrue(os.path.exists(
+                os.path.join(self.directory.name, '0-file.png')))
+
+class ProcessOrbitTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = write_file(self.directory.name, sample_file_15())
+        self.orbit = images.orbit
+        images.orbit = lambda number, filename: path
+        self.savepath = os.path.join(self.directory.name, 'orbit-{orbit}.png')
+
+    def tearDown(self):
+        images.orbit = self.orbit
+        self.directory.cleanup()
+
+    def testReport(self):
+        report = images._process_orbit(376, self.savepath, 2, None)
+        self.assertIsNone(report['error'])
+        self.assertEqual(sorted(report), ['decode', 'error', 'fetch', 'orbit',
+                                          'stitch', 'write'])
+        self.assertTrue(os.path.exists(
+                os.path.join(self.directory.name, '0-orbit-376.png')))
+
+    @unittest.skipIf(images.resource is None, 'No resource module.')
+    def testMemoryBudget(self):
+        limit = images.resource.getrlimit(images.resource.RLIMIT_AS)
+        # Far less than the interpreter has already, so the orbit
+        # can't be read, but that's reported rather than raised.
+        report = images._process_orbit(376, self.savepath, 2, 1 << 20)
+        self.assertIsNotNone(report['error'])
+        self.assertEqual(images.resource.getrlimit(images.resource.RLIMIT_AS),
+                         limit)
+        report = images._process_orbit(376, self.savepath, 2, None)
+        self.assertIsNone(report['error'])
+
+class TiledMosaicTests(unittest.TestCase):
+    def mosaic_picture(self, mosaic):
+        return np.block([[np.asarray(mosaic.tile(row, column))
+                          for column in range(mosaic.tile_columns)]
+                         for row in range(mosaic.tile_rows)])
+
+    def testMatchesStitch(self):
+        sources = [image_file_15(overlapping_placements),
+                   image_file_15([(33, 30, 8, 14), (22, 12, 5, 20)])]
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [write_file(directory, source, f'FILE_15-{i}')
+                     for i, source in enumerate(sources)]
+            for count in [1, 2]:
+                records = [record for source in sources[:count]
+                           for record in f_bidr.read_logical_records(source)[1:]]
+                expected = images.image_stitch(records, None)
+                # 6 divides neither side, and records cross tiles.
+                self.assertTrue(expected.shape[0] % 6 and expected.shape[1] % 6)
+                mosaic = images.stitch_tiled(paths[:count],
+                        os.path.join(directory, 'mosaic'), tile_size=6)
+                np.testing.assert_array_equal(self.mosaic_picture(mosaic),
+                                              expected)
+                del mosaic
+
+class ImagePyramidTests(unittest.TestCase):
+    def level(self, pyramid, zoom):
+        rows, columns = pyramid.tile_counts(zoom)
+        return np.block([[pyramid.tile(zoom, row, column)
+                          for column in range(columns)] for row in range(rows)])
+
+    def testOverlapping(self):
+        rng = np.random.default_rng(5)
+        picture = np.zeros((21, 26), np.uint8)
+        placed = np.zeros(picture.shape, bool)
+        with tempfile.TemporaryDirectory() as directory:
+            pyramid = images.ImagePyramid(directory, *picture.shape, tile_size=4)
+            for top, left, height, width in [(0, 0, 9, 10), (5, 6, 10, 12),
+                                             (3, 2, 4, 20), (12, 14, 9, 12)]:
+                image = rng.integers(0, 256, (height, width), np.uint8)
+                valids = rng.random((height, width)) < 0.8
+                pyramid.place(top, left, image, valids)
+                region = (slice(top, top + height), slice(left, left + width))
+                np.copyto(picture[region], image, where=valids)
+                placed[region] |= valids
+
+            self.assertEqual(pyramid.levels, 4)
+            np.testing.assert_array_equal(
+                    self.level(pyramid, pyramid.levels - 1), picture)
+            for zoom in range(pyramid.levels - 1):
+                factor = 2 ** (pyramid.levels - 1 - zoom)
+                np.testing.assert_array_equal(self.level(pyramid, zoom),
+                        block_means(picture, placed, factor))
+            del pyramid
+
+    def testStitchPyramid(self):
+        records = f_bidr.read_logical_records(
+                image_file_15(overlapping_placements))[1:]
+        picture = images.image_stitch(records, None)
+        placed = images.image_stitch(
+                [dict(r, data=[dict(line, line=bytes([1]) * len(line['line']))
+                               for line in r['data']]) for r in records],
+                None).astype(bool)
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_file(directory, image_file_15(overlapping_placements))
+            tiles = os.path.join(directory, 'tiles')
+            images.stitch_pyramid([path], tiles, tile_size=8)
+            with open(os.path.join(tiles, 'pyramid.json')) as f:
+                levels = json.load(f)['levels']
+            for zoom in range(levels):
+                factor = 2 ** (levels - 1 - zoom)
+                expected = block_means(picture, placed, factor)
+                columns = -(-expected.shape[1] // 8)
+                rows = -(-expected.shape[0] // 8)
+                found = np.block([[imageio.v2.imread(os.path.join(
+                                        tiles, str(zoom), str(column), f'{row}.png'))
+                                   for column in range(columns)]
+                                  for row in range(rows)])
+                np.testing.assert_array_equal(found, expected)
+
 # Other record types. Stand-ins for some things.
 tdb_seconds = R.Float('double')
 wall_clock_time = R.FixedLengthString(19)